@@ -1,5 +1,23 @@
 from boiga import *
 from math import floor, ceil
+import argparse
+import struct
+import os
+import sys
+
+# host.py sits next to this file, which is not on the path under `python3 -m risc-v`
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import host
+
+parser = argparse.ArgumentParser(description="Build the RISC-V emulator project.")
+parser.add_argument("elf", nargs="?", help="RV32 ELF file to load into DRAM at build time")
+parser.add_argument("--preboot", type=int, metavar="STEPS",
+                help="run up to STEPS instructions of the ELF on the host and ship the resulting machine state")
+parser.add_argument("--preboot-until", type=lambda s: int(s, 0), metavar="ADDR",
+                help="stop pre-boot when the guest reaches ADDR")
+parser.add_argument("--tiles", metavar="PNG",
+                help="image of 16x16 tiles, left to right and top to bottom, to use for the tile map")
+args = parser.parse_args()
 
 project = Project()
 
@@ -7,29 +25,188 @@ empty = project.new_sprite("empty")
 
 emu = project.new_sprite("RISCV32")
 
-DRAM_SIZE = 200000
+# Store one 32-bit little-endian word per _DRAM item instead of one byte.
+# Aligned word accesses become a single list access and the 200000 item
+# list limit covers four times as much guest RAM.
+WORD_DRAM = False
+
+# Split byte DRAM into this many lists of BANK_SIZE bytes, for more guest RAM
+# than one list can hold. Bank 0 holds the first BANK_SIZE bytes in place and
+# is grown a DRAM_PAGE at a time when stored to. Pages above it are mapped by
+# _DRAM_PAGES into the next free page of the other banks when first stored to.
+# Memory never stored to costs nothing and reads as 0, and a reset only has to
+# empty the lists.
+DRAM_BANKS = 1
+BANK_SIZE = host.BANK_SIZE
+DRAM_PAGE = 4096
+
+if DRAM_BANKS > 1 and WORD_DRAM:
+                raise Exception("DRAM banks need byte DRAM")
+
+# Decode RVC (compressed) instructions. Instructions can then start at any
+# 16-bit boundary, so the decode cache has an entry per halfword of DRAM and
+# _JIT_SIZE holds the length in bytes of the instruction at each entry.
+RVC = False
+
+if RVC and WORD_DRAM:
+                raise Exception("RVC needs byte DRAM; the decode cache would exceed the list limit")
+
+DRAM_SIZE = host.dram_size(WORD_DRAM, DRAM_BANKS)
 DRAM_BASE = 0x80000000
 
-CODE_MAX = 100000
-
-dram = emu.new_list("_DRAM", [0] * DRAM_SIZE)
-jit = emu.new_list("_JIT_CACHE", [0] * 4 * CODE_MAX)
-regs = emu.new_list("_REGS", [0] * 32)
-csrs = emu.new_list("_CSRS", [0] * 4096)
-pc = emu.new_var("_PC")
-ticks = emu.new_var("_TICKS")
+# DRAM covered by the decode cache, which code has to run from. The cache has
+# an entry per 2 or 4 bytes, and a list holds at most 200000 items.
+CODE_SIZE = min(DRAM_SIZE, 200000 * (2 if RVC else 4))
+
+STACK_TOP = DRAM_BASE + DRAM_SIZE
+
+# Console size in characters
+ROWS = 21
+COLS = 60
+
+if args.elf:
+                elf_image, ENTRY = host.load_elf(args.elf, DRAM_SIZE)
+else:
+                elf_image, ENTRY = bytearray(), DRAM_BASE
+
+# Machine state after the guest's start-up has been run on the host. The guest
+# runs until it touches a device other than UART output, so the state is the
+# same as the project would reach.
+boot = None
+memory = elf_image
+if args.preboot or args.preboot_until:
+                if not args.elf:
+                                raise Exception("Pre-boot needs an ELF file")
+                boot = host.Machine(elf_image, ENTRY, DRAM_SIZE, ROWS, COLS, strict=True, rvc=RVC)
+                print("Pre-boot stopped: " + boot.run(args.preboot or float("inf"), args.preboot_until))
+                memory = boot.dram
+
+dram_items = DRAM_SIZE // 4 if WORD_DRAM else DRAM_SIZE
+if WORD_DRAM:
+                dram_contents = list(struct.unpack("<%dI" % ceil(len(memory) / 4), memory + bytes(-len(memory) % 4)))
+elif DRAM_BANKS > 1:
+                # Bank 0 up to its last page that is not all zeros, then the other
+                # pages that are not all zeros, mapped in address order
+                data = bytes(memory[:BANK_SIZE])
+                dram_contents = list(data[:ceil(len(data.rstrip(b"\0")) / DRAM_PAGE) * DRAM_PAGE])
+                page_contents = [0] * (DRAM_SIZE // DRAM_PAGE)
+                pool = []
+                for page in range(BANK_SIZE // DRAM_PAGE, DRAM_SIZE // DRAM_PAGE):
+                                data = bytes(memory[page * DRAM_PAGE:(page + 1) * DRAM_PAGE])
+                                if any(data):
+                                                page_contents[page] = BANK_SIZE + len(pool)
+                                                pool += data.ljust(DRAM_PAGE, b"\0")
+                bank_contents = [dram_contents] + [pool[k * BANK_SIZE:(k + 1) * BANK_SIZE] for k in range(DRAM_BANKS - 1)]
+else:
+                dram_contents = list(memory)
+if DRAM_BANKS > 1:
+                banks = [emu.new_list("_DRAM" + (str(k) if k else ""), bank_contents[k]) for k in range(DRAM_BANKS)]
+                dram = banks[0]
+                # Where each DRAM_PAGE above bank 0 lives, as bank * BANK_SIZE +
+                # offset (0 until it is first stored to)
+                dram_pages = emu.new_list("_DRAM_PAGES", page_contents)
+else:
+                dram = emu.new_list("_DRAM", dram_contents + [0] * (dram_items - len(dram_contents)))
+                banks = [dram]
+
+# Set by reset. Lists in a freshly loaded project are all zero, so the first
+# boot does not need to clear them.
+dirty = emu.new_var("_DIRTY")
+
+# Bytes of DRAM per decode cache entry, and entries per 32-bit instruction
+JIT_STRIDE = 2 if RVC else 4
+INST_ENTRIES = 4 // JIT_STRIDE
+
+# Decoded instructions, indexed by (pc - DRAM_BASE) / JIT_STRIDE. _JIT_CACHE
+# packs the internal opcode and the first two register fields as
+# op * JIT_OP + a * 32 + b (0 means not decoded), _JIT_IMM holds the third
+# field (an immediate or rs2) and _JIT_BLOCKS the length of the block starting
+# at that instruction. In RVC builds the block length is stored as
+# instructions * BLOCK_SPAN + entries spanned.
+JIT_OP = 1024
+BLOCK_SPAN = 256
+
+jit = emu.new_list("_JIT_CACHE", [0] * (CODE_SIZE // JIT_STRIDE))
+jit_imm = emu.new_list("_JIT_IMM", [0] * (CODE_SIZE // JIT_STRIDE))
+blocks = emu.new_list("_JIT_BLOCKS", [0] * (CODE_SIZE // JIT_STRIDE))
+if RVC:
+                sizes = emu.new_list("_JIT_SIZE", [0] * (CODE_SIZE // JIT_STRIDE))
+
+# Bytes per _CODE_PAGES entry, which is set once an instruction in that part
+# of DRAM has been decoded. Stores elsewhere leave the decode cache alone.
+CODE_PAGE = 4096
+
+code_pages = emu.new_list("_CODE_PAGES", [0] * (CODE_SIZE // CODE_PAGE + 1))
+regs = emu.new_list("_REGS", boot.regs if boot else [0, 0, STACK_TOP] + [0] * 29)
+csrs = emu.new_list("_CSRS", boot.csrs if boot else [0] * 4096)
+pc = emu.new_var("_PC", boot.pc if boot else ENTRY)
+ticks = emu.new_var("_TICKS", boot.ticks if boot else 0)
 jit_index = emu.new_var("_JIT_INDEX")
 
-code = emu.new_list("_CODE", monitor=[240, 145, 120, 20])
+# Guest image that reset copies into DRAM. A build-time ELF is also baked
+# straight into _DRAM, so the first boot skips the copy. Banks read as 0 past
+# their end, so with banks the image can drop its trailing zeros.
+code = emu.new_list("_CODE", list(bytes(elf_image).rstrip(b"\0") if DRAM_BANKS > 1 else elf_image), monitor=[240, 145, 120, 20])
 
 uart = emu.new_list("_OUTPUT_BUF")
-input = emu.new_list("_INPUT_BUF")
-history = emu.new_list("_OUTPUT_HIST")
-newlines = emu.new_var("newlines")
-h_lines = emu.new_var("history_lines")
 
-x = emu.new_var("x")
-y = emu.new_var("y")
+# UART receive queue: characters are appended to _INPUT_BUF and read from
+# input_head, and the list is emptied once everything has been read.
+input = emu.new_list("_INPUT_BUF")
+input_head = emu.new_var("input_head", 0)
+
+# Timer ticks per second of the CLINT mtime register
+MTIME_FREQ = 1000000
+
+mtime = emu.new_var("mtime")
+mtimecmp_lo = emu.new_var("mtimecmp_lo", 0xffffffff)
+mtimecmp_hi = emu.new_var("mtimecmp_hi", 0xffffffff)
+
+# Set to 1 by wfi, and by a read or a UART status poll with no input queued.
+# The scheduler leaves the guest alone until input arrives or mtime reaches
+# mtimecmp. Set to 2 for good by exit.
+waiting = emu.new_var("waiting", 0)
+
+# _CONSOLE holds the character codes on screen (0 for blank) as a ring of
+# rows, with the top row at console_top.
+console = emu.new_list("_CONSOLE", boot.console if boot else [0] * (ROWS * COLS))
+top = emu.new_var("console_top", boot.top if boot else 0)
+scrolled = emu.new_var("console_scrolled")
+
+x = emu.new_var("x", boot.x if boot else 0)
+y = emu.new_var("y", boot.y if boot else 0)
+
+# The tile map covers the stage with TILE_COLS x TILE_ROWS tiles of TILE
+# pixels, one byte each in DRAM at tile_map (0 for none). _TILE_SHADOW holds
+# the tiles on screen, and is emptied whenever the pen layer is cleared.
+TILE = 16
+TILE_COLS = 480 // TILE
+TILE_ROWS = 360 // TILE
+
+tile_map = emu.new_var("tile_map", 0)
+tiles_pending = emu.new_var("tiles_pending", 0)
+tile_shadow = emu.new_list("_TILE_SHADOW")
+
+# Machine state kept by save_snapshot: pc, ticks, console_top, x, y, the two
+# halves of mtimecmp and tile_map, then _REGS, _CSRS, _CONSOLE and with banks
+# _DRAM_PAGES. Each DRAM bank has a list of its own, as a list holds at most
+# 200000 items.
+state_lists = [(regs, 32), (csrs, 4096), (console, ROWS * COLS)]
+if DRAM_BANKS > 1:
+                state_lists.append((dram_pages, DRAM_SIZE // DRAM_PAGE))
+SNAPSHOT_SIZE = 8 + sum(size for lst, size in state_lists)
+
+snapshot = emu.new_list("_SNAPSHOT")
+snapshot_banks = [emu.new_list("_SNAPSHOT_DRAM" + (str(k) if k else "")) for k in range(DRAM_BANKS)]
+
+# A pre-booted project ships with its boot state in the same layout, kept
+# apart from _SNAPSHOT so a save never replaces it.
+if boot:
+                boot_state = emu.new_list("_BOOT", [boot.pc, boot.ticks, boot.top, boot.x, boot.y,
+                                boot.mtimecmp & 0xffffffff, boot.mtimecmp >> 32, boot.tile_map]
+                                + boot.regs + boot.csrs + boot.console + (page_contents if DRAM_BANKS > 1 else []))
+                boot_banks = [emu.new_list("_BOOT_DRAM" + (str(k) if k else ""),
+                                bank_contents[k] if DRAM_BANKS > 1 else dram_contents) for k in range(DRAM_BANKS)]
 
 and_lut_contents = []
 for a in range(256):
@@ -66,17 +243,37 @@ ascii_lut = emu.new_list("_ASCII", ascii)
 
 hex_lut = emu.new_var("_HEXA", '0123456789abcdef')
 
-@emu.proc_def()
-def clear_screen (locals): return [
-                uart.delete_all(),
-                x <= 0,
-                y <= 0,
+# Blanks the console row the cursor is on
+@emu.proc_def(inline_only=True)
+def clear_row (locals): return [
+                locals.row <= ((top + y) % ROWS) * COLS,
+                locals.i[:COLS:1] >> [
+                                console[locals.row + locals.i] <= 0
+                ]
+]
+
+@emu.proc_def(inline_only=True)
+def clear_pen (locals): return [
                 SetSize(100),
                 SetCostume("bg"),
                 SetXYPos(0, 0),
                 Show(),
                 Stamp(),
                 SetSize(50),
+                tile_shadow.delete_all(),
+                tiles_pending <= 1
+]
+
+@emu.proc_def()
+def clear_screen (locals): return [
+                uart.delete_all(),
+                locals.i[:console.len():1] >> [
+                                console[locals.i] <= 0
+                ],
+                top <= 0,
+                x <= 0,
+                y <= 0,
+                clear_pen().inline(),
                 SetXYPos(-240, 180),
                 SetCostume("cursor")
                 
@@ -129,26 +326,146 @@ def draw_triangle (locals, Ax, Ay, Bx, By, Cx, Cy, res): return [
                 PenUp()
 ]
 
+# Appends value to lst count times, unrolled to cut loop overhead
+def fill (lst, count, value, unroll=8): return [
+                Repeat (floor(count / unroll)) [
+                                [lst.append(value) for _ in range(unroll)]
+                ],
+                Repeat (count % unroll) [
+                                lst.append(value)
+                ]
+]
+
+# Empties the decode cache. Only pages that held decoded code have entries
+# to clear.
+@emu.proc_def()
+def jit_clear (locals): return [
+                locals.page <= 0,
+                Repeat (code_pages.len()) [
+                                If (code_pages[locals.page] == 1) [
+                                                code_pages[locals.page] <= 0,
+                                                locals.i <= locals.page * (CODE_PAGE // JIT_STRIDE),
+                                                Repeat (CODE_PAGE // JIT_STRIDE) [
+                                                                jit[locals.i] <= 0,
+                                                                blocks[locals.i] <= 0,
+                                                                locals.i.changeby(1)
+                                                ]
+                                ],
+                                locals.page.changeby(1)
+                ]
+]
+
+if DRAM_BANKS > 1:
+
+                # Looks up the page holding index, past bank 0, in _DRAM_PAGES.
+                # Leaves bank 0 for a page that is not mapped.
+                def find_page (locals, index): return [
+                                locals.entry <= dram_pages[floor(index / DRAM_PAGE)],
+                                locals.bank <= floor(locals.entry / BANK_SIZE),
+                                locals.offset <= locals.entry - locals.bank * BANK_SIZE + index % DRAM_PAGE
+                ]
+
+                # Maps page to the next free page of the banks past bank 0
+                @emu.proc_def()
+                def map_page (locals, page): return [
+                                locals.used <= sum([lst.len() for lst in banks[2:]], banks[1].len()),
+                                [If (floor(locals.used / BANK_SIZE) + 1 == k) [
+                                                fill(lst, DRAM_PAGE, 0)
+                                ] for k, lst in enumerate(banks) if k],
+                                dram_pages[page] <= BANK_SIZE + locals.used
+                ]
+
+# Appends the code image to empty DRAM banks: bank 0 in place, then each page
+# past it that is not all zeros to a page mapped for it
+def append_code (locals): return [
+                locals.i <= 0,
+                RepeatUntil ((locals.i > code.len() - 1).OR(locals.i > BANK_SIZE - 1)) [
+                                dram.append(code[locals.i]),
+                                locals.i.changeby(1)
+                ],
+                locals.page <= BANK_SIZE // DRAM_PAGE,
+                RepeatUntil (locals.i > code.len() - 1) [
+                                locals.end <= (locals.page + 1) * DRAM_PAGE,
+                                RepeatUntil ((locals.i > code.len() - 1).OR(locals.i == locals.end).OR(code[locals.i] != 0)) [
+                                                locals.i.changeby(1)
+                                ],
+                                If ((locals.i < code.len()).AND(locals.i < locals.end)) [
+                                                map_page(locals.page),
+                                                locals.i <= locals.page * DRAM_PAGE,
+                                                find_page(locals, locals.i),
+                                                [If (locals.bank == k) [
+                                                                RepeatUntil ((locals.i > code.len() - 1).OR(locals.i == locals.end)) [
+                                                                                lst[locals.offset] <= code[locals.i],
+                                                                                locals.offset.changeby(1),
+                                                                                locals.i.changeby(1)
+                                                                ]
+                                                ] for k, lst in enumerate(banks) if k]
+                                ],
+                                locals.i <= locals.end,
+                                locals.page.changeby(1)
+                ]
+]
+
 @emu.proc_def()
 def reset (locals): return [
                 clear_screen(),
-                newlines <= 0,
-                h_lines <= 0,
-                history.delete_all(),
-                locals.i[:DRAM_SIZE:1] >> [
-                                dram[locals.i] <= 0
-                ],
-                locals.i[:CODE_MAX*4:1] >> [
-                                jit[locals.i] <= 0
-                ],
-                locals.i[:code.len():1] >> [
-                                dram[locals.i+0x0] <= code[locals.i]
+                input.delete_all(),
+                input_head <= 0,
+                waiting <= 0,
+                tile_map <= 0,
+                mtimecmp_lo <= 0xffffffff,
+                mtimecmp_hi <= 0xffffffff,
+                If (dirty == 1) [
+                                jit_clear(),
+                                # Empty the banks and page table and copy the code image back in
+                                [lst.delete_all() for lst in banks],
+                                dram_pages.delete_all(),
+                                fill(dram_pages, DRAM_SIZE // DRAM_PAGE, 0),
+                                append_code(locals)
+                ].Else [
+                                [] if elf_image else append_code(locals)
+                ] if DRAM_BANKS > 1 else
+                If (dirty == 1) [
+                                jit_clear(),
+                                # Rebuild DRAM from the code image and zeros
+                                dram.delete_all(),
+                                locals.i <= 0,
+                                Repeat (ceil(code.len() / 4)) [
+                                                dram.append(code[locals.i]
+                                                                + code[locals.i + 1] * 0x100
+                                                                + code[locals.i + 2] * 0x10000
+                                                                + code[locals.i + 3] * 0x1000000),
+                                                locals.i.changeby(4)
+                                ]
+                                if WORD_DRAM else
+                                locals.i[:code.len():1] >> [
+                                                dram.append(code[locals.i])
+                                ],
+                                fill(dram, dram_items - dram.len(), 0)
+                ].Else [
+                                # Freshly loaded: everything is still zero apart from
+                                # any image baked in at build time
+                                [] if elf_image else [
+                                                locals.i <= 0,
+                                                Repeat (ceil(code.len() / 4)) [
+                                                                dram[locals.i / 4] <= code[locals.i]
+                                                                                + code[locals.i + 1] * 0x100
+                                                                                + code[locals.i + 2] * 0x10000
+                                                                                + code[locals.i + 3] * 0x1000000,
+                                                                locals.i.changeby(4)
+                                                ]
+                                                if WORD_DRAM else
+                                                locals.i[:code.len():1] >> [
+                                                                dram[locals.i] <= code[locals.i]
+                                                ]
+                                ]
                 ],
+                dirty <= 1,
                 locals.i[:32:1] >> [
                                 regs[locals.i] <= 0
                 ],
-                regs[2] <= DRAM_SIZE,
-                pc <= DRAM_BASE,
+                regs[2] <= STACK_TOP,
+                pc <= ENTRY,
                 ticks <= 0
 ]
 
@@ -156,6 +473,12 @@ result = emu.new_var("_RESULT")
 
 ### Functions for sign extension
 
+# A 32-bit value plus 2^31, wrapped, which puts signed values in unsigned
+# order. signed32 gives the signed value. Both are plain expressions, so they
+# can be used inside others without a write to result.
+def bias32 (value): return (value + 2147483648) % 4294967296
+def signed32 (value): return bias32(value) - 2147483648
+
 @emu.proc_def(inline_only=True)
 def toSigned32 (locals, int): return [
                 result <= (int + 2147483648) % 4294967296 - 2147483648
@@ -208,15 +531,16 @@ def sub (locals, a, b): return [
                 result <= (a - b) & 0xffffffff
 ]
 
+# The products are taken against the 16-bit halves of b, so each one fits
+# in the 53 bits a double holds exactly. a and b may be signed.
 @emu.proc_def(inline_only=True)
 def multiply (locals, a, b): return [
-                toUnsigned32(a * b).inline(),
-                result <= result & 0xffffffff
+                result <= (a * (b & 0xffff) + ((a * (b >> 16)) & 0xffff) * 0x10000) & 0xffffffff
 ]
 
 @emu.proc_def(inline_only=True)
 def multiply_upper (locals, a, b): return [
-                toUnsigned32((a * b) >> 32).inline()
+                toUnsigned32((a * (b >> 16) + ((a * (b & 0xffff)) >> 16)) >> 16).inline()
 ]
 
 @emu.proc_def(inline_only=True)
@@ -265,8 +589,7 @@ def b_shift_right (locals, a, b): return [
 
 @emu.proc_def(inline_only=True)
 def b_shift_right_arith (locals, a, b): return [
-                toSigned32(a).inline(),
-                toUnsigned32(floor(result / base2_lut[b])).inline()
+                result <= floor(signed32(a) / base2_lut[b]) % 4294967296
 ]
 
 @emu.proc_def(inline_only=True)
@@ -280,210 +603,717 @@ def less_than_unsigned (locals, a, b): return [
 
 @emu.proc_def(inline_only=True)
 def less_than_signed (locals, a, b): return [
-                toSigned32(a).inline(),
-                locals.signed <= result,
-                toSigned32(b).inline(),
-                If (locals.signed < result) [
-                                result <= 1
-                ].Else [
-                                result <= 0
-                ]
+                less_than_unsigned(bias32(a), bias32(b)).inline()
 ]
 
+### Dispatch
+
+# Internal opcode dispatch strategy for execute:
+#  "tree"   - balanced binary decision tree over the opcode IDs (log2(n) comparisons)
+#  "linear" - one range test per opcode, in OPCODE_PROFILE order
+DISPATCH = "tree"
+
+# Measured execution counts per internal opcode ({opcode: count}), e.g. read back
+# from the _frequency list of a PROFILE_OPCODES build. Frequent opcodes are placed
+# closer to the root of the decision tree, or earlier in the linear chain.
+OPCODE_PROFILE = {}
+
+# Count executed internal opcodes in the _frequency list
+PROFILE_OPCODES = False
+
+# value holds the case key in multiples of scale, with lower fields below it.
+def dispatch (value, cases, profile={}, scale=1):
+                keys = sorted(cases)
+                if DISPATCH == "linear":
+                                def test (k):
+                                                if scale == 1:
+                                                                return value == k
+                                                return (value > k * scale - 1).AND(value < (k + 1) * scale)
+                                keys.sort(key=lambda k: -profile.get(k, 0))
+                                chain = [If (test(keys[-1])) [cases[keys[-1]]]]
+                                for k in reversed(keys[:-1]):
+                                                chain = [If (test(k)) [cases[k]].Else [chain]]
+                                return chain
+                # The cases cover every value that can reach the dispatcher, so
+                # a single remaining key needs no equality test.
+                def split (keys):
+                                if len(keys) == 1:
+                                                return cases[keys[0]]
+                                weights = [profile.get(k, 0) + 1 for k in keys]
+                                total = sum(weights)
+                                best = 1
+                                left = weights[0]
+                                best_left = left
+                                for i in range(2, len(keys)):
+                                                left += weights[i-1]
+                                                if abs(total - 2*left) < abs(total - 2*best_left):
+                                                                best, best_left = i, left
+                                return [If (value < keys[best] * scale) [split(keys[:best])].Else [split(keys[best:])]]
+                return split(keys)
+
+# Like dispatch, for values that may match none of the cases (integers only).
+def dispatch_sparse (value, cases):
+                cases = dict(cases)
+                for k in list(cases):
+                                cases.setdefault(k + 1, [])
+                cases.setdefault(min(cases) - 1, [])
+                return dispatch(value, cases)
+
 ### Memory and bus operations
 
 bus_result = emu.new_var("_bus_result")
 
+if WORD_DRAM:
+                # index is a byte offset into DRAM; base2_lut[8*n] shifts by n bytes.
+
+                @emu.proc_def(inline_only=True)
+                def mem_load32 (locals, index): return [
+                                locals.shift <= index % 4,
+                                If (locals.shift == 0) [
+                                                bus_result <= dram[index / 4]
+                                ].Else [
+                                                locals.word <= (index - locals.shift) / 4,
+                                                locals.shift <= base2_lut[locals.shift * 8],
+                                                bus_result <= floor(dram[locals.word] / locals.shift)
+                                                + (dram[locals.word + 1] % locals.shift) * (4294967296 / locals.shift)
+                                ]
+                ]
+
+                @emu.proc_def(inline_only=True)
+                def mem_load16 (locals, index): return [
+                                locals.shift <= index % 4,
+                                locals.word <= (index - locals.shift) / 4,
+                                If (locals.shift == 3) [
+                                                bus_result <= floor(dram[locals.word] / 0x1000000)
+                                                + (dram[locals.word + 1] % 0x100) * 0x100
+                                ].Else [
+                                                bus_result <= floor(dram[locals.word] / base2_lut[locals.shift * 8]) % 0x10000
+                                ]
+                ]
+
+                @emu.proc_def(inline_only=True)
+                def mem_load8 (locals, index): return [
+                                locals.shift <= index % 4,
+                                bus_result <= floor(dram[(index - locals.shift) / 4] / base2_lut[locals.shift * 8]) % 0x100
+                ]
+
+elif DRAM_BANKS > 1:
+                # Bank 0 is read in place and the other pages through a call. Items
+                # past the end of bank 0 are "", which sums count as 0, and so are
+                # pages never stored to and addresses past the end of DRAM.
+
+                @emu.proc_def()
+                def bank_load8 (locals, index): return [
+                                If (index < BANK_SIZE) [
+                                                bus_result <= floor(dram[index]),
+                                                StopThisScript()
+                                ],
+                                find_page(locals, index),
+                                If (locals.bank == 0) [
+                                                bus_result <= 0
+                                ].Else [
+                                                dispatch(locals.bank, {
+                                                                k: [bus_result <= floor(lst[locals.offset])]
+                                                for k, lst in enumerate(banks) if k})
+                                ]
+                ]
+
+                @emu.proc_def()
+                def bank_load (locals, index, size): return [
+                                If (index % DRAM_PAGE > DRAM_PAGE - size) [ # runs into the next page
+                                                locals.value <= 0,
+                                                locals.i <= size,
+                                                Repeat (size) [
+                                                                locals.i.changeby(-1),
+                                                                bank_load8(index + locals.i),
+                                                                locals.value <= locals.value * 256 + bus_result
+                                                ],
+                                                bus_result <= locals.value
+                                ].Else [
+                                                find_page(locals, index),
+                                                If (locals.bank == 0) [
+                                                                bus_result <= 0
+                                                ].Else [
+                                                                dispatch(locals.bank, {k: [
+                                                                                bus_result <= lst[locals.offset]
+                                                                                + (lst[locals.offset + 1] << 8),
+                                                                                If (size == 4) [
+                                                                                                bus_result <= bus_result
+                                                                                                + (lst[locals.offset + 2] << 16)
+                                                                                                + (lst[locals.offset + 3] << 24)
+                                                                                ]
+                                                                ] for k, lst in enumerate(banks) if k})
+                                                ]
+                                ]
+                ]
+
+                @emu.proc_def(inline_only=True)
+                def mem_load32 (locals, index): return [
+                                If (index < BANK_SIZE - 3) [
+                                                bus_result <= dram[index]
+                                                + (dram[index+1] << 8)
+                                                + (dram[index+2] << 16)
+                                                + (dram[index+3] << 24)
+                                ].Else [
+                                                bank_load(index, 4)
+                                ]
+                ]
+
+                @emu.proc_def(inline_only=True)
+                def mem_load16 (locals, index): return [
+                                If (index < BANK_SIZE - 1) [
+                                                bus_result <= dram[index]
+                                                + (dram[index+1] << 8)
+                                ].Else [
+                                                bank_load(index, 2)
+                                ]
+                ]
+
+                @emu.proc_def(inline_only=True)
+                def mem_load8 (locals, index): return [
+                                If (index < BANK_SIZE) [
+                                                bus_result <= floor(dram[index])
+                                ].Else [
+                                                bank_load8(index)
+                                ]
+                ]
+
+else:
+
+                @emu.proc_def(inline_only=True)
+                def mem_load32 (locals, index): return [
+                                bus_result <= dram[index]
+                                + (dram[index+1] << 8)
+                                + (dram[index+2] << 16)
+                                + (dram[index+3] << 24)
+                ]
+
+                @emu.proc_def(inline_only=True)
+                def mem_load16 (locals, index): return [
+                                bus_result <= dram[index]
+                                + (dram[index+1] << 8)
+                ]
+
+                @emu.proc_def(inline_only=True)
+                def mem_load8 (locals, index): return [
+                                bus_result <= dram[index]
+                ]
+
+# index is a byte offset into DRAM; list indices are floored
 @emu.proc_def(inline_only=True)
-def mem_load32 (locals, index): return [
-                bus_result <= dram[index]
-                + (dram[index+1] << 8)
-                + (dram[index+2] << 16)
-                + (dram[index+3] << 24)
+def jit_invalidate (locals, index): return [
+                If (code_pages[index / CODE_PAGE] == 1) [
+                                jit[index / 4] <= 0,
+                                jit[index / 4 - 1] <= 0 # may be fused with the instruction written to
+                ]
+] if not RVC else [
+                # The entry written to, a 32-bit instruction starting 2 bytes
+                # earlier, and the first halves of fused pairs ending at either
+                If (code_pages[index / CODE_PAGE] == 1) [
+                                jit[index / 2] <= 0,
+                                jit[index / 2 - 1] <= 0,
+                                jit[index / 2 - 2] <= 0,
+                                jit[index / 2 - 3] <= 0
+                ]
 ]
 
-@emu.proc_def(inline_only=True)
-def mem_load16 (locals, index): return [
-                bus_result <= dram[index]
-                + (dram[index+1] << 8)
+# Same for DRAM bytes start to end - 1, a page of code at a time
+@emu.proc_def()
+def jit_invalidate_range (locals, start, end): return [
+                locals.page <= floor(start / CODE_PAGE),
+                Repeat (ceil(end / CODE_PAGE) - locals.page) [
+                                If (code_pages[locals.page] == 1) [
+                                                If (locals.page == floor(start / CODE_PAGE)) [
+                                                                locals.i <= floor(start / JIT_STRIDE) - (2 * INST_ENTRIES - 1)
+                                                ].Else [
+                                                                locals.i <= locals.page * (CODE_PAGE // JIT_STRIDE) - (2 * INST_ENTRIES - 1)
+                                                ],
+                                                locals.last <= floor((end - 1) / JIT_STRIDE),
+                                                If (locals.last > (locals.page + 1) * (CODE_PAGE // JIT_STRIDE) - 1) [
+                                                                locals.last <= (locals.page + 1) * (CODE_PAGE // JIT_STRIDE) - 1
+                                                ],
+                                                RepeatUntil (locals.i > locals.last) [
+                                                                jit[locals.i] <= 0,
+                                                                locals.i.changeby(1)
+                                                ]
+                                ],
+                                locals.page.changeby(1)
+                ]
 ]
 
+if WORD_DRAM:
+
+                @emu.proc_def()
+                def mem_store8 (locals, index, value): return [
+                                locals.shift <= index % 4,
+                                locals.word <= (index - locals.shift) / 4,
+                                locals.shift <= base2_lut[locals.shift * 8],
+                                dram[locals.word] <= dram[locals.word]
+                                + (value - floor(dram[locals.word] / locals.shift) % 0x100) * locals.shift,
+                                jit_invalidate(index).inline()
+                ]
+
+                @emu.proc_def()
+                def mem_store16 (locals, index, value): return [
+                                locals.shift <= index % 4,
+                                If (locals.shift == 3) [
+                                                mem_store8(index, value & 0xff),
+                                                mem_store8(index + 1, (value >> 8) & 0xff),
+                                                StopThisScript()
+                                ],
+                                locals.word <= (index - locals.shift) / 4,
+                                locals.shift <= base2_lut[locals.shift * 8],
+                                dram[locals.word] <= dram[locals.word]
+                                + (value - floor(dram[locals.word] / locals.shift) % 0x10000) * locals.shift,
+                                jit_invalidate(index).inline()
+                ]
+
+                @emu.proc_def()
+                def mem_store32 (locals, index, value): return [
+                                If (index % 4 == 0) [
+                                                dram[index / 4] <= value,
+                                                jit_invalidate(index).inline()
+                                ].Else [
+                                                mem_store8(index, value & 0xff),
+                                                mem_store8(index + 1, (value >> 8) & 0xff),
+                                                mem_store8(index + 2, (value >> 16) & 0xff),
+                                                mem_store8(index + 3, (value >> 24) & 0xff)
+                                ]
+                ]
+
+elif DRAM_BANKS > 1:
+
+                # Appends zeros to lst up to the end of the page holding offset
+                def grow (lst, offset): return [
+                                If (offset > lst.len() - 1) [
+                                                fill(lst, (floor(offset / DRAM_PAGE) + 1) * DRAM_PAGE - lst.len(), 0)
+                                ]
+                ]
+
+                # Stores past the end of DRAM are dropped
+                @emu.proc_def()
+                def mem_store8 (locals, index, value): return [
+                                If (index < BANK_SIZE) [
+                                                grow(dram, index),
+                                                dram[index] <= value,
+                                                jit_invalidate(index).inline()
+                                ].Else [
+                                                If (index < DRAM_SIZE) [
+                                                                If (dram_pages[floor(index / DRAM_PAGE)] == 0) [
+                                                                                map_page(floor(index / DRAM_PAGE))
+                                                                ],
+                                                                find_page(locals, index),
+                                                                dispatch(locals.bank, {
+                                                                                k: [lst[locals.offset] <= value]
+                                                                for k, lst in enumerate(banks) if k}),
+                                                                jit_invalidate(index).inline()
+                                                ]
+                                ]
+                ]
+
+else:
+
+                @emu.proc_def()
+                def mem_store8 (locals, index, value): return [
+                                dram[index] <= value,
+                                jit_invalidate(index).inline()
+                ]
+
 @emu.proc_def(inline_only=True)
-def mem_load8 (locals, index): return [
-                bus_result <= dram[index]
+def console_write (locals, value): return [
+                uart.append(value)
 ]
 
+### Devices
+
+# Each device gets the register offset within its page, and a whole access
+# of size bytes (1, 2 or 4) in one call.
+
 @emu.proc_def()
-def hw_load8 (locals, addr): return [
-                If (addr == 0x10000000) [
-                                bus_result <= input[0],
-                                input.delete_at(0),
-                                StopThisScript()
+def uart_store (locals, offset, value, size): return [
+                If (offset == 0) [
+                                console_write(value & 0xff).inline()
+                ]
+]
+
+@emu.proc_def()
+def uart_load (locals, offset, size): return [
+                If ((offset == 0).AND(input.len() > input_head)) [ # receive buffer
+                                bus_result <= input[input_head],
+                                input_head.changeby(1),
+                                If (input_head == input.len()) [
+                                                input.delete_all(),
+                                                input_head <= 0
+                                ]
                 ],
-                If (addr == 0x10000005) [
-                                If (input.len() > 0) [
-                                                bus_result <= 1
+                If ((offset < 6).AND(offset + size > 5)) [ # line status: data ready
+                                If (input.len() > input_head) [
+                                                bus_result <= bus_result + base2_lut[(5 - offset) * 8]
                                 ].Else [
-                                                bus_result <= 0
-                                ],
-                                StopThisScript()
+                                                # Polling for input: sleep as a blocking read
+                                                # would, and have the bus end the frame
+                                                waiting <= 1
+                                ]
                 ]
 ]
 
-@emu.proc_def(inline_only=True)
-def bus_load32 (locals, addr): return [
-                If (addr < DRAM_BASE) [
-                                hw_load8(addr),
-                                locals.result <= bus_result,
-                                hw_load8(addr),
-                                locals.result <= locals.result + (bus_result << 8),
-                                hw_load8(addr),
-                                locals.result <= locals.result + (bus_result << 16),
-                                hw_load8(addr),
-                                bus_result <= locals.result + (bus_result << 24)
-                ].Else [
-                                mem_load32(addr - DRAM_BASE).inline()
+@emu.proc_def()
+def pen_store (locals, offset, value, size): return [
+                locals.offset <= offset,
+                locals.value <= value,
+                Repeat (size) [
+                                locals.byte <= locals.value % 256,
+                                dispatch_sparse(locals.offset, {
+                                                0: [locals.x <= locals.byte],
+                                                1: [SetXYPos(locals.x * 1.88 - 240, locals.byte * 1.4 - 180)],
+                                                2: [SetPenParam("color", locals.byte / 256 * 100)],
+                                                3: [
+                                                                If (locals.byte == 0) [
+                                                                                PenUp()
+                                                                ].Else [
+                                                                                SetPenSize(locals.byte),
+                                                                                PenDown()
+                                                                ]
+                                                ],
+                                                4: [clear_screen()]
+                                }),
+                                locals.value <= floor(locals.value / 256),
+                                locals.offset.changeby(1)
                 ]
 ]
 
-@emu.proc_def(inline_only=True)
-def bus_load16 (locals, addr): return [
-                If (addr < DRAM_BASE) [
-                                hw_load8(addr),
-                                locals.result <= bus_result,
-                                hw_load8(addr),
-                                bus_result <= locals.result + (bus_result << 8)
-                ].Else [
-                                mem_load16(addr - DRAM_BASE).inline()
+@emu.proc_def()
+def triangle_store (locals, offset, value, size): return [
+                locals.offset <= offset,
+                locals.value <= value,
+                Repeat (size) [
+                                locals.byte <= locals.value % 256,
+                                dispatch_sparse(locals.offset, {
+                                                0: [locals.xa <= locals.byte],
+                                                1: [locals.ya <= locals.byte],
+                                                2: [locals.xb <= locals.byte],
+                                                3: [locals.yb <= locals.byte],
+                                                4: [locals.xc <= locals.byte],
+                                                5: [draw_triangle(locals.xa * 1.88 - 240, locals.ya * 1.4 - 180, locals.xb * 1.88 - 240, locals.yb * 1.4 - 180, locals.xc * 1.88 - 240, locals.byte * 1.4 - 180, 4)]
+                                }),
+                                locals.value <= floor(locals.value / 256),
+                                locals.offset.changeby(1)
                 ]
 ]
 
+# CLINT timer, at the SiFive CLINT addresses. mtime counts MTIME_FREQ ticks
+# a second from the start of 2000 and ignores writes. Both registers are 64
+# bits wide and accessed as two 32-bit halves.
+
 @emu.proc_def(inline_only=True)
-def bus_load8 (locals, addr): return [
-                If (addr < DRAM_BASE) [
-                                hw_load8(addr)
-                ].Else [
-                                mem_load8(addr - DRAM_BASE).inline()
+def read_mtime (locals): return [
+                mtime <= (DaysSince2k() * 86400000).round() * (MTIME_FREQ // 1000)
+]
+
+@emu.proc_def()
+def mtimecmp_store (locals, offset, value, size): return [
+                If (offset == 0) [
+                                mtimecmp_lo <= value
+                ],
+                If (offset == 4) [
+                                mtimecmp_hi <= value
                 ]
 ]
 
 @emu.proc_def()
-def mem_store8 (locals, index, value): return [
-                dram[index] <= value,
-                jit[index*4] <= 0
+def mtimecmp_load (locals, offset, size): return [
+                If (offset == 0) [
+                                bus_result <= mtimecmp_lo
+                ],
+                If (offset == 4) [
+                                bus_result <= mtimecmp_hi
+                ]
 ]
 
-@emu.proc_def(inline_only=True)
-def prune_history (locals): return [
-                Repeat (h_lines-20) [
-                                RepeatUntil (history[0] == 10) [
-                                                history.delete_at(0)
-                                ],
-                                history.delete_at(0)
+@emu.proc_def()
+def mtime_load (locals, offset, size): return [
+                read_mtime().inline(),
+                If (offset == 0xff8) [
+                                bus_result <= mtime % 4294967296
                 ],
-                h_lines <= 20
+                If (offset == 0xffc) [
+                                bus_result <= floor(mtime / 4294967296)
+                ]
 ]
 
-@emu.proc_def(inline_only=True)
-def console_write (locals, value): return [
-                uart.append(value),
-                history.append(value),
-                If (value == 10) [
-                                newlines.changeby(1),
-                                h_lines.changeby(1),
-                                If (h_lines > 20) [
-                                                prune_history().inline()
+# DMA engine for bulk copies and fills within DRAM. The guest sets the
+# source and destination addresses (0 and 4) and a length in bytes (8), then
+# writes a mode to 12: 1 copies, allowing overlap, and 2 fills with the low
+# byte of the source register. The transfer is over by the time that store
+# returns. Ranges reaching outside DRAM are ignored.
+
+@emu.proc_def()
+def dma_copy (locals, src, dst, length): return [
+                If ((dst > src).AND(dst < src + length)) [ # overlapping, so copy backwards
+                                locals.s <= src + length - 1,
+                                locals.d <= dst + length - 1,
+                                locals.step <= -1
+                ].Else [
+                                locals.s <= src,
+                                locals.d <= dst,
+                                locals.step <= 1
+                ],
+                If ((src % 4 == 0).AND(dst % 4 == 0).AND(length % 4 == 0)) [
+                                locals.s <= floor(locals.s / 4),
+                                locals.d <= floor(locals.d / 4),
+                                Repeat (length / 4) [
+                                                dram[locals.d] <= dram[locals.s],
+                                                locals.s.changeby(locals.step),
+                                                locals.d.changeby(locals.step)
+                                ]
+                ].Else [
+                                Repeat (length) [
+                                                mem_load8(locals.s).inline(),
+                                                mem_store8(locals.d, bus_result),
+                                                locals.s.changeby(locals.step),
+                                                locals.d.changeby(locals.step)
                                 ]
                 ]
+] if WORD_DRAM else [
+                If ((dst > src).AND(dst < src + length)) [ # overlapping, so copy backwards
+                                locals.s <= src + length - 1,
+                                locals.d <= dst + length - 1,
+                                locals.step <= -1
+                ].Else [
+                                locals.s <= src,
+                                locals.d <= dst,
+                                locals.step <= 1
+                ],
+                Repeat (length) [
+                                [
+                                                mem_load8(locals.s).inline(),
+                                                mem_store8(locals.d, bus_result)
+                                ] if DRAM_BANKS > 1 else
+                                dram[locals.d] <= dram[locals.s],
+                                locals.s.changeby(locals.step),
+                                locals.d.changeby(locals.step)
+                ]
 ]
 
 @emu.proc_def()
-def hw_store8 (locals, addr, value): return [
-                If (addr == 0x10002000) [
-                                locals.x <= value,
-                                StopThisScript()
+def dma_fill (locals, dst, length, value): return [
+                If ((dst % 4 == 0).AND(length % 4 == 0)) [
+                                locals.d <= dst / 4,
+                                Repeat (length / 4) [
+                                                dram[locals.d] <= value * 0x1010101,
+                                                locals.d.changeby(1)
+                                ]
+                ].Else [
+                                locals.d <= dst,
+                                Repeat (length) [
+                                                mem_store8(locals.d, value),
+                                                locals.d.changeby(1)
+                                ]
+                ]
+] if WORD_DRAM else [
+                locals.d <= dst,
+                Repeat (length) [
+                                mem_store8(locals.d, value) if DRAM_BANKS > 1 else
+                                dram[locals.d] <= value,
+                                locals.d.changeby(1)
+                ]
+]
+
+@emu.proc_def()
+def dma_store (locals, offset, value, size): return [
+                If (offset == 0) [
+                                locals.src <= value
                 ],
-                If (addr == 0x10002001) [
-                                SetXYPos(locals.x * 1.88 - 240, value * 1.4 - 180),
-                                StopThisScript()
+                If (offset == 4) [
+                                locals.dst <= value
                 ],
-                If (addr == 0x10002002) [
-                                SetPenParam("color", value / 256 * 100),
-                                StopThisScript()
+                If (offset == 8) [
+                                locals.len <= value
                 ],
-                If (addr == 0x10002003) [
-                                If (value == 0) [
-                                                PenUp()
-                                ].Else [
-                                                SetPenSize(value),
-                                                PenDown()
+                If (offset == 12) [
+                                locals.s <= locals.src - DRAM_BASE,
+                                locals.d <= locals.dst - DRAM_BASE,
+                                If ((locals.len < 1).OR(locals.d < 0).OR(locals.d + locals.len > DRAM_SIZE)) [
+                                                StopThisScript()
                                 ],
-                                StopThisScript()
-                ],
-                If (addr == 0x10002004) [
-                                clear_screen(),
-                                StopThisScript()
-                ],
-                If (addr == 0x10000000) [
-                                console_write(value).inline(),
-                                StopThisScript()
-                ],
-                If (addr == 0x10003000) [
-                                locals.txa <= value,
-                                StopThisScript()
-                ],
-                If (addr == 0x10003001) [
-                                locals.tya <= value,
-                                StopThisScript()
-                ],
-                If (addr == 0x10003002) [
-                                locals.txb <= value,
-                                StopThisScript()
+                                If ((value == 1).AND(locals.s > -1).AND(locals.s + locals.len < DRAM_SIZE + 1)) [
+                                                dma_copy(locals.s, locals.d, locals.len)
+                                ],
+                                If (value == 2) [
+                                                dma_fill(locals.d, locals.len, locals.src % 256)
+                                ],
+                                jit_invalidate_range(locals.d, locals.d + locals.len)
+                ]
+]
+
+@emu.proc_def()
+def dma_load (locals, offset, size): return [
+                If (offset == 0) [
+                                bus_result <= dma_store.src
                 ],
-                If (addr == 0x10003003) [
-                                locals.tyb <= value,
-                                StopThisScript()
+                If (offset == 4) [
+                                bus_result <= dma_store.dst
                 ],
-                If (addr == 0x10003004) [
-                                locals.txc <= value,
-                                StopThisScript()
+                If (offset == 8) [
+                                bus_result <= dma_store.len
+                ]
+]
+
+# Tile map. The guest stores the DRAM address of its map to 0 and then
+# presents it by storing anything to 4. Changed tiles are stamped at the end
+# of the frame, over any console text.
+
+# Costume number of tile 0, after bg, the font, the cursor and the capitals
+TILE_COSTUME = 256 + 2 + 26 + 1
+
+@emu.proc_def()
+def tile_store (locals, offset, value, size): return [
+                If (offset == 0) [
+                                tile_map <= value,
+                                tile_shadow.delete_all()
                 ],
-                If (addr == 0x10003005) [
-                                draw_triangle(locals.txa * 1.88 - 240, locals.tya * 1.4 - 180, locals.txb * 1.88 - 240, locals.tyb * 1.4 - 180, locals.txc * 1.88 - 240, value * 1.4 - 180, 4),
-                                StopThisScript()
+                If (offset == 4) [
+                                tiles_pending <= 1
+                ]
+]
+
+@emu.proc_def()
+def tile_load (locals, offset, size): return [
+                If (offset == 0) [
+                                bus_result <= tile_map
+                ]
+]
+
+@emu.proc_def()
+def draw_tiles (locals): return [
+                tiles_pending <= 0,
+                locals.addr <= tile_map - DRAM_BASE,
+                If ((locals.addr < 0).OR(locals.addr + TILE_COLS * TILE_ROWS > DRAM_SIZE)) [
+                                StopThisScript()
+                ],
+                If (tile_shadow.len() == 0) [
+                                fill(tile_shadow, TILE_COLS * TILE_ROWS, -1)
+                ],
+                locals.i <= 0,
+                locals.row <= 0,
+                Repeat (TILE_ROWS) [
+                                locals.col <= 0,
+                                Repeat (TILE_COLS) [
+                                                mem_load8(locals.addr + locals.i).inline(),
+                                                If (bus_result != tile_shadow[locals.i]) [
+                                                                tile_shadow[locals.i] <= bus_result,
+                                                                SetXYPos(locals.col * TILE - 240, 180 - locals.row * TILE),
+                                                                SetCostume(bus_result + TILE_COSTUME),
+                                                                Stamp()
+                                                ],
+                                                locals.i.changeby(1),
+                                                locals.col.changeby(1)
+                                ],
+                                locals.row.changeby(1)
+                ]
+]
+
+# Memory-mapped devices below DRAM_BASE by 4 KB page: (store, load)
+DEVICES = {
+                0x02004: (mtimecmp_store, mtimecmp_load), # 0x02004000 CLINT mtimecmp
+                0x0200b: (None, mtime_load), # 0x0200bff8 CLINT mtime
+                0x10000: (uart_store, uart_load), # 0x10000000 UART
+                0x10002: (pen_store, None), # 0x10002000 pen graphics
+                0x10003: (triangle_store, None), # 0x10003000 filled triangles
+                0x10004: (dma_store, dma_load), # 0x10004000 DMA
+                0x10005: (tile_store, tile_load) # 0x10005000 tile map
+}
+
+@emu.proc_def()
+def hw_store (locals, addr, value, size): return [
+                locals.page <= floor(addr / 4096),
+                locals.offset <= addr - locals.page * 4096,
+                dispatch_sparse(locals.page, {
+                                page: [store(locals.offset, value, size)]
+                for page, (store, load) in DEVICES.items() if store})
+]
+
+# Unmapped registers read as 0
+@emu.proc_def()
+def hw_load (locals, addr, size): return [
+                bus_result <= 0,
+                locals.page <= floor(addr / 4096),
+                locals.offset <= addr - locals.page * 4096,
+                dispatch_sparse(locals.page, {
+                                page: [load(locals.offset, size)]
+                for page, (store, load) in DEVICES.items() if load})
+]
+
+### Bus
+
+@emu.proc_def(inline_only=True)
+def bus_load32 (locals, addr): return [
+                If (addr < DRAM_BASE) [
+                                hw_load(addr, 4),
+                                If (waiting == 1) [
+                                                execute.running <= 0
+                                ]
+                ].Else [
+                                mem_load32(addr - DRAM_BASE).inline()
+                ]
+]
+
+@emu.proc_def(inline_only=True)
+def bus_load16 (locals, addr): return [
+                If (addr < DRAM_BASE) [
+                                hw_load(addr, 2),
+                                If (waiting == 1) [
+                                                execute.running <= 0
+                                ]
+                ].Else [
+                                mem_load16(addr - DRAM_BASE).inline()
+                ]
+]
+
+@emu.proc_def(inline_only=True)
+def bus_load8 (locals, addr): return [
+                If (addr < DRAM_BASE) [
+                                hw_load(addr, 1),
+                                If (waiting == 1) [
+                                                execute.running <= 0
+                                ]
+                ].Else [
+                                mem_load8(addr - DRAM_BASE).inline()
                 ]
 ]
 
 @emu.proc_def(inline_only=True)
 def bus_store32 (locals, addr, value): return [
                 If (addr < DRAM_BASE) [
-                                hw_store8(addr, value & 0xff),
-                                hw_store8(addr + 1, (value >> 8) & 0xff),
-                                hw_store8(addr + 2, (value >> 16) & 0xff),
-                                hw_store8(addr + 3, (value >> 24) & 0xff)
+                                hw_store(addr, value, 4)
                 ].Else [
-                                mem_store8(addr - DRAM_BASE, value & 0xff),
-                                mem_store8(addr - DRAM_BASE + 1, (value >> 8) & 0xff),
-                                mem_store8(addr - DRAM_BASE + 2, (value >> 16) & 0xff),
-                                mem_store8(addr - DRAM_BASE + 3, (value >> 24) & 0xff)
+                                mem_store32(addr - DRAM_BASE, value)
+                                if WORD_DRAM else [
+                                                mem_store8(addr - DRAM_BASE, value & 0xff),
+                                                mem_store8(addr - DRAM_BASE + 1, (value >> 8) & 0xff),
+                                                mem_store8(addr - DRAM_BASE + 2, (value >> 16) & 0xff),
+                                                mem_store8(addr - DRAM_BASE + 3, (value >> 24) & 0xff)
+                                ]
                 ]
 ]
 
 @emu.proc_def(inline_only=True)
 def bus_store16 (locals, addr, value): return [
                 If (addr < DRAM_BASE) [
-                                hw_store8(addr, value & 0xff),
-                                hw_store8(addr, (value >> 8) & 0xff)
+                                hw_store(addr, value & 0xffff, 2)
                 ].Else [
-                                mem_store8(addr - DRAM_BASE, value & 0xff),
-                                mem_store8(addr - DRAM_BASE + 1, (value >> 8) & 0xff)
+                                mem_store16(addr - DRAM_BASE, value & 0xffff)
+                                if WORD_DRAM else [
+                                                mem_store8(addr - DRAM_BASE, value & 0xff),
+                                                mem_store8(addr - DRAM_BASE + 1, (value >> 8) & 0xff)
+                                ]
                 ]
 ]
 
 @emu.proc_def(inline_only=True)
 def bus_store8 (locals, addr, value): return [
                 If (addr < DRAM_BASE) [
-                                hw_store8(addr, value & 0xff).inline()
+                                hw_store(addr, value & 0xff, 1)
                 ].Else [
                                 mem_store8(addr - DRAM_BASE, value & 0xff).inline()
                 ]
@@ -491,38 +1321,151 @@ def bus_store8 (locals, addr, value): return [
 
 @emu.proc_def(inline_only=True)
 def fetch (locals, pc): return [
+                bus_result <= dram[(pc - DRAM_BASE) / 4]
+] if WORD_DRAM else [
                 locals.index <= pc - DRAM_BASE,
                 mem_load32(locals.index).inline()
 ]
 
+### Control and status registers
+
+# Counters kept by the emulator rather than in _CSRS: cycle (0xc00) and
+# instret (0xc02) count retired instructions, from _TICKS, and time (0xc01) is
+# mtime. The upper halves are 0x80 above. Writes to them are ignored.
+
+# Reads csr into result and then, by mode, writes value to it (1), sets the
+# bits set in value (2) or clears them (3), as csrrw, csrrs and csrrc
+@emu.proc_def()
+def csr_access (locals, csr, value, mode): return [
+                If ((csr > 0xbff).AND(csr < 0xc83).AND(csr % 0x80 < 3)) [
+                                If (csr % 0x80 == 1) [ # time
+                                                read_mtime().inline(),
+                                                locals.count <= mtime
+                                ].Else [
+                                                # CSR ops end their block, so _TICKS counts up to this one
+                                                locals.count <= ticks - 1
+                                ],
+                                If (csr > 0xc7f) [
+                                                result <= floor(locals.count / 4294967296)
+                                ].Else [
+                                                result <= locals.count % 4294967296
+                                ],
+                                StopThisScript()
+                ],
+                locals.old <= csrs[csr],
+                If (mode == 1) [
+                                csrs[csr] <= value
+                ].Else [
+                                b_and(locals.old, value).inline(),
+                                If (mode == 2) [
+                                                csrs[csr] <= locals.old + value - result
+                                ].Else [
+                                                csrs[csr] <= locals.old - result
+                                ]
+                ],
+                result <= locals.old
+]
+
+### System calls
+
+# Linux error numbers, as register values
+EBADF = 2 ** 32 - 9
+EFAULT = 2 ** 32 - 14
+
+exit_code = emu.new_var("exit_code")
+
+# Linux-style calls made by ecall, with the call number in a7, arguments in
+# a0-a2 and the result in a0. Other numbers only end the frame, as every
+# system instruction used to, which is flagged in end_frame. Output goes to
+# the console whole, and a read returns up to the end of a line of queued
+# input.
+@emu.proc_def()
+def syscall (locals): return [
+                locals.end_frame <= 0,
+                locals.buf <= regs[11] - DRAM_BASE,
+                locals.count <= regs[12],
+                If ((regs[17] == 63).OR(regs[17] == 64).AND((locals.buf < 0).OR(locals.buf + locals.count > DRAM_SIZE))) [
+                                regs[10] <= EFAULT,
+                                StopThisScript()
+                ],
+                If (regs[17] == 64) [ # write(fd, buf, count)
+                                If ((regs[10] == 1).OR(regs[10] == 2)) [
+                                                Repeat (locals.count) [
+                                                                mem_load8(locals.buf).inline(),
+                                                                console_write(bus_result).inline(),
+                                                                locals.buf.changeby(1)
+                                                ],
+                                                regs[10] <= locals.count
+                                ].Else [
+                                                regs[10] <= EBADF
+                                ],
+                                StopThisScript()
+                ],
+                If (regs[17] == 63) [ # read(fd, buf, count)
+                                If (regs[10] != 0) [
+                                                regs[10] <= EBADF,
+                                                StopThisScript()
+                                ],
+                                If ((input.len() == input_head).AND(locals.count > 0)) [
+                                                # Sleep, and run the ecall again once there is input
+                                                pc <= pc - 4,
+                                                waiting <= 1,
+                                                locals.end_frame <= 1,
+                                                StopThisScript()
+                                ],
+                                locals.n <= 0,
+                                RepeatUntil ((locals.n == locals.count).OR(input.len() == input_head)) [
+                                                locals.char <= input[input_head],
+                                                input_head.changeby(1),
+                                                mem_store8(locals.buf + locals.n, locals.char),
+                                                locals.n.changeby(1),
+                                                If (locals.char == 10) [
+                                                                locals.count <= locals.n
+                                                ]
+                                ],
+                                If (input_head == input.len()) [
+                                                input.delete_all(),
+                                                input_head <= 0
+                                ],
+                                regs[10] <= locals.n,
+                                StopThisScript()
+                ],
+                If ((regs[17] == 93).OR(regs[17] == 94)) [ # exit(code), exit_group(code)
+                                exit_code <= regs[10],
+                                pc <= pc - 4,
+                                waiting <= 2
+                ],
+                locals.end_frame <= 1
+]
+
 ### Decoders
 
 @emu.proc_def(inline_only=True)
 def decode_r_type (locals, inst): return [
-                jit[jit_index+1] <= (inst >> 7) & 0x1f, # rd
-                jit[jit_index+2] <= (inst >> 15) & 0x1f, # rs1
-                jit[jit_index+3] <= (inst >> 20) & 0x1f, # rs2
+                jit[jit_index] <= ((inst >> 7) & 0x1f) * 32 # rd
+                                + ((inst >> 15) & 0x1f), # rs1
+                jit_imm[jit_index] <= (inst >> 20) & 0x1f, # rs2
                 locals.funct3 <= (inst >> 12) & 0x7,
                 locals.funct7 <= inst >> 25
 ]
 
 @emu.proc_def(inline_only=True)
 def decode_i_type (locals, inst): return [
-                jit[jit_index+1] <= (inst >> 7) & 0x1f, # rd
-                jit[jit_index+2] <= (inst >> 15) & 0x1f, # rs1
+                jit[jit_index] <= ((inst >> 7) & 0x1f) * 32 # rd
+                                + ((inst >> 15) & 0x1f), # rs1
                 locals.funct3 <= (inst >> 12) & 0x7
 ]
 
 @emu.proc_def(inline_only=True)
 def decode_i_type_signed (locals, inst): return [
                 toSigned32(inst).inline(),
-                jit[jit_index+3] <= result >> 20 # imm
+                jit_imm[jit_index] <= result >> 20 # imm
 ]
 
 @emu.proc_def(inline_only=True)
 def decode_i_type_signed_shift (locals, inst): return [
                 toSigned32(inst).inline(),
-                jit[jit_index+3] <= (result >> 20) & 0x1f, # imm
+                jit_imm[jit_index] <= (result >> 20) & 0x1f, # imm
                 locals.funct7 <= inst >> 25,
 ]
 
@@ -530,125 +1473,126 @@ def decode_i_type_signed_shift (locals, inst): return [
 def decode_i_type_unsigned (locals, inst): return [
                 toSigned32(inst).inline(),
                 toUnsigned32(result >> 20).inline(),
-                jit[jit_index+3] <= result # imm
+                jit_imm[jit_index] <= result # imm
 ]
 
 @emu.proc_def(inline_only=True)
 def decode_i_type_csr (locals, inst): return [
-                jit[jit_index+1] <= (inst >> 7) & 0x1f, # rd
-                jit[jit_index+2] <= (inst >> 15) & 0x1f, # rs1
+                jit[jit_index] <= ((inst >> 7) & 0x1f) * 32 # rd
+                                + ((inst >> 15) & 0x1f), # rs1
                 locals.funct3 <= (inst >> 12) & 0x7,
-                jit[jit_index+3] <= inst >> 20 # imm
+                jit_imm[jit_index] <= inst >> 20 # imm
 ]
 
 @emu.proc_def(inline_only=True)
 def decode_s_type (locals, inst): return [
-                jit[jit_index+1] <= (inst >> 15) & 0x1f, # rs1
-                jit[jit_index+2] <= (inst >> 20) & 0x1f, # rs2
+                jit[jit_index] <= ((inst >> 15) & 0x1f) * 32 # rs1
+                                + ((inst >> 20) & 0x1f), # rs2
                 locals.funct3 <= (inst >> 12) & 0x7,
                 toSigned32(inst).inline(),
                 toUnsigned32(result >> 25).inline(),
-                jit[jit_index+3] <= (result << 5) + ((inst >> 7) & 0x1f) # imm
+                jit_imm[jit_index] <= (result << 5) + ((inst >> 7) & 0x1f) # imm
 ]
 
 @emu.proc_def(inline_only=True)
 def decode_b_type (locals, inst): return [
-                jit[jit_index+1] <= (inst >> 15) & 0x1f, # rs1
-                jit[jit_index+2] <= (inst >> 20) & 0x1f, # rs2
+                jit[jit_index] <= ((inst >> 15) & 0x1f) * 32 # rs1
+                                + ((inst >> 20) & 0x1f), # rs2
                 locals.funct3 <= (inst >> 12) & 0x7,
                 toSigned32(inst).inline(),
-                jit[jit_index+3] <= ((result >> 31) << 12) + (((inst >> 7) & 0x01) << 11) + (((inst >> 25) & 0x3f) << 5) + (((inst >> 8) & 0x0f) << 1) # imm
+                jit_imm[jit_index] <= ((result >> 31) << 12) + (((inst >> 7) & 0x01) << 11) + (((inst >> 25) & 0x3f) << 5) + (((inst >> 8) & 0x0f) << 1) # imm
 ]
 
 @emu.proc_def(inline_only=True)
 def decode_u_type (locals, inst): return [
-                jit[jit_index+1] <= (inst >> 7) & 0x1f, # rd
-                jit[jit_index+3] <= (inst >> 12) << 12 # imm
+                jit[jit_index] <= ((inst >> 7) & 0x1f) * 32, # rd
+                jit_imm[jit_index] <= (inst >> 12) << 12 # imm
 ]
 
 @emu.proc_def(inline_only=True)
 def decode_j_type (locals, inst): return [
-                jit[jit_index+1] <= (inst >> 7) & 0x1f, # rd
+                jit[jit_index] <= ((inst >> 7) & 0x1f) * 32, # rd
                 toSigned32(inst).inline(),
-                jit[jit_index+3] <= ((result >> 31) << 20) + (((inst >> 12) & 0xff) << 12) + (((inst >> 20) & 0x01) << 11) + (((inst >> 21) & 0x03ff) << 1) # imm
+                jit_imm[jit_index] <= ((result >> 31) << 20) + (((inst >> 12) & 0xff) << 12) + (((inst >> 20) & 0x01) << 11) + (((inst >> 21) & 0x03ff) << 1) # imm
 ]
 
 @emu.proc_def()
 def jit_compile (locals, inst): return [
+                jit[jit_index] <= 0,
                 locals.opcode <= inst & 0x7f,
                 If (locals.opcode == 0b0010011) [
                                 decode_i_type(inst).inline(),
                                 If (decode_i_type.funct3 == 0x0) [ # addi
                                                 decode_i_type_signed(inst).inline(),
-                                                jit[jit_index] <= 1,
+                                                jit[jit_index] <= jit[jit_index] + 1 * JIT_OP,
                                                 StopThisScript()
                                 ],
                                 If (decode_i_type.funct3 == 0x4) [ # xori
                                                 decode_i_type_unsigned(inst).inline(),
-                                                jit[jit_index] <= 2,
+                                                jit[jit_index] <= jit[jit_index] + 2 * JIT_OP,
                                                 StopThisScript()
                                 ],
                                 If (decode_i_type.funct3 == 0x6) [ # ori
                                                 decode_i_type_unsigned(inst).inline(),
-                                                jit[jit_index] <= 3,
+                                                jit[jit_index] <= jit[jit_index] + 3 * JIT_OP,
                                                 StopThisScript()
                                 ],
                                 If (decode_i_type.funct3 == 0x7) [ # andi
                                                 decode_i_type_unsigned(inst).inline(),
-                                                jit[jit_index] <= 4,
+                                                jit[jit_index] <= jit[jit_index] + 4 * JIT_OP,
                                                 StopThisScript()
                                 ],
                                 If (decode_i_type.funct3 == 0x1) [ # slli
                                                 decode_i_type_signed(inst).inline(),
-                                                jit[jit_index] <= 5,
+                                                jit[jit_index] <= jit[jit_index] + 5 * JIT_OP,
                                                 StopThisScript()
                                 ],
                                 If (decode_i_type.funct3 == 0x5) [
                                                 decode_i_type_signed_shift(inst).inline(),
                                                 If (decode_i_type_signed_shift.funct7 == 0x0) [ # srli
-                                                                jit[jit_index] <= 6,
+                                                                jit[jit_index] <= jit[jit_index] + 6 * JIT_OP,
                                                                 StopThisScript()
                                                 ],
                                                 If (decode_i_type_signed_shift.funct7 == 0b0100000) [ # srai
-                                                                jit[jit_index] <= 7,
+                                                                jit[jit_index] <= jit[jit_index] + 7 * JIT_OP,
                                                                 StopThisScript()
                                                 ]
                                 ],
                                 If (decode_i_type.funct3 == 0x2) [ # slti
                                                 decode_i_type_signed(inst).inline(),
-                                                jit[jit_index] <= 8,
+                                                jit[jit_index] <= jit[jit_index] + 8 * JIT_OP,
                                                 StopThisScript()
                                 ],
                                 If (decode_i_type.funct3 == 0x3) [ # sltiu
                                                 decode_i_type_unsigned(inst).inline(),
-                                                jit[jit_index] <= 9,
+                                                jit[jit_index] <= jit[jit_index] + 9 * JIT_OP,
                                                 StopThisScript()
                                 ]
                 ],
                 If (locals.opcode == 0b1100011) [
                                 decode_b_type(inst).inline(),
                                 If (decode_b_type.funct3 == 0x0) [ # beq
-                                                jit[jit_index] <= 10,
+                                                jit[jit_index] <= jit[jit_index] + 10 * JIT_OP,
                                                 StopThisScript()
                                 ],
                                 If (decode_b_type.funct3 == 0x1) [ # bne
-                                                jit[jit_index] <= 11,
+                                                jit[jit_index] <= jit[jit_index] + 11 * JIT_OP,
                                                 StopThisScript()
                                 ],
                                 If (decode_b_type.funct3 == 0x6) [ # bltu
-                                                jit[jit_index] <= 12,
+                                                jit[jit_index] <= jit[jit_index] + 12 * JIT_OP,
                                                 StopThisScript()
                                 ],
                                 If (decode_b_type.funct3 == 0x7) [ # bgeu
-                                                jit[jit_index] <= 13,
+                                                jit[jit_index] <= jit[jit_index] + 13 * JIT_OP,
                                                 StopThisScript()
                                 ],
                                 If (decode_b_type.funct3 == 0x4) [ # blt
-                                                jit[jit_index] <= 14,
+                                                jit[jit_index] <= jit[jit_index] + 14 * JIT_OP,
                                                 StopThisScript()
                                 ],
                                 If (decode_b_type.funct3 == 0x5) [ # bge
-                                                jit[jit_index] <= 15,
+                                                jit[jit_index] <= jit[jit_index] + 15 * JIT_OP,
                                                 StopThisScript()
                                 ]
                 ],
@@ -656,79 +1600,79 @@ def jit_compile (locals, inst): return [
                                 decode_r_type(inst).inline(),
                                 If (decode_r_type.funct7 == 0b0) [
                                                 If (decode_r_type.funct3 == 0x0) [ # add
-                                                                jit[jit_index] <= 16,
+                                                                jit[jit_index] <= jit[jit_index] + 16 * JIT_OP,
                                                                 StopThisScript()
                                                 ],
                                                 If (decode_r_type.funct3 == 0x4) [ # xor
-                                                                jit[jit_index] <= 18,
+                                                                jit[jit_index] <= jit[jit_index] + 18 * JIT_OP,
                                                                 StopThisScript()
                                                 ],
                                                 If (decode_r_type.funct3 == 0x6) [ # or
-                                                                jit[jit_index] <= 19,
+                                                                jit[jit_index] <= jit[jit_index] + 19 * JIT_OP,
                                                                 StopThisScript()
                                                 ],
                                                 If (decode_r_type.funct3 == 0x7) [ # and
-                                                                jit[jit_index] <= 20,
+                                                                jit[jit_index] <= jit[jit_index] + 20 * JIT_OP,
                                                                 StopThisScript()
                                                 ],
                                                 If (decode_r_type.funct3 == 0x1) [ # sll
-                                                                jit[jit_index] <= 21,
+                                                                jit[jit_index] <= jit[jit_index] + 21 * JIT_OP,
                                                                 StopThisScript()
                                                 ],
                                                 If (decode_r_type.funct3 == 0x5) [ # srl
-                                                                jit[jit_index] <= 22,
+                                                                jit[jit_index] <= jit[jit_index] + 22 * JIT_OP,
                                                                 StopThisScript()
                                                 ],
                                                 If (decode_r_type.funct3 == 0x2) [ # slt
-                                                                jit[jit_index] <= 24,
+                                                                jit[jit_index] <= jit[jit_index] + 24 * JIT_OP,
                                                                 StopThisScript()
                                                 ],
                                                 If (decode_r_type.funct3 == 0x3) [ # sltu
-                                                                jit[jit_index] <= 25,
+                                                                jit[jit_index] <= jit[jit_index] + 25 * JIT_OP,
                                                                 StopThisScript()
                                                 ]
                                 ],
                                 If (decode_r_type.funct7 == 0x20) [
                                                 If (decode_r_type.funct3 == 0x0) [ # sub
-                                                                jit[jit_index] <= 17,
+                                                                jit[jit_index] <= jit[jit_index] + 17 * JIT_OP,
                                                                 StopThisScript()
                                                 ],
                                                 If (decode_r_type.funct3 == 0x5) [ # sra
-                                                                jit[jit_index] <= 23,
+                                                                jit[jit_index] <= jit[jit_index] + 23 * JIT_OP,
                                                                 StopThisScript()
                                                 ]
                                 ],
                                 If (decode_r_type.funct7 == 0x1) [
                                                 If (decode_r_type.funct3 == 0x0) [ # mul
-                                                                jit[jit_index] <= 40,
+                                                                jit[jit_index] <= jit[jit_index] + 40 * JIT_OP,
                                                                 StopThisScript()
                                                 ],
                                                 If (decode_r_type.funct3 == 0x1) [ # mulh
-                                                                jit[jit_index] <= 41,
+                                                                jit[jit_index] <= jit[jit_index] + 41 * JIT_OP,
                                                                 StopThisScript()
                                                 ],
-                                                If (decode_r_type.funct3 == 0x2) [ # mulhu
-                                                                jit[jit_index] <= 42,
+                                                If (decode_r_type.funct3 == 0x2) [ # mulhsu
+                                                                jit[jit_index] <= jit[jit_index] + 43 * JIT_OP,
                                                                 StopThisScript()
                                                 ],
-                                                If (decode_r_type.funct3 == 0x3) [ # mulhsu
-                                                                jit[jit_index] <= 43,
+                                                If (decode_r_type.funct3 == 0x3) [ # mulhu
+                                                                jit[jit_index] <= jit[jit_index] + 42 * JIT_OP,
                                                                 StopThisScript()
                                                 ],
                                                 If (decode_r_type.funct3 == 0x4) [ # div
-                                                                jit[jit_index] <= 44,
+                                                                jit[jit_index] <= jit[jit_index] + 44 * JIT_OP,
                                                                 StopThisScript()
                                                 ],
                                                 If (decode_r_type.funct3 == 0x5) [ # divu
-                                                                jit[jit_index] <= 45,
+                                                                jit[jit_index] <= jit[jit_index] + 45 * JIT_OP,
                                                                 StopThisScript()
                                                 ],
                                                 If (decode_r_type.funct3 == 0x6) [ # rem
-                                                                jit[jit_index] <= 46,
+                                                                jit[jit_index] <= jit[jit_index] + 46 * JIT_OP,
                                                                 StopThisScript()
                                                 ],
                                                 If (decode_r_type.funct3 == 0x7) [ # remu
-                                                                jit[jit_index] <= 47,
+                                                                jit[jit_index] <= jit[jit_index] + 47 * JIT_OP,
                                                                 StopThisScript()
                                                 ]
                                 ]
@@ -737,340 +1681,536 @@ def jit_compile (locals, inst): return [
                                 decode_i_type(inst).inline(),
                                 decode_i_type_signed(inst).inline(),
                                 If (decode_i_type.funct3 == 0x0) [ # lb
-                                                jit[jit_index] <= 26,
+                                                jit[jit_index] <= jit[jit_index] + 26 * JIT_OP,
                                                 StopThisScript()
                                 ],
                                 If (decode_i_type.funct3 == 0x1) [ # lh
-                                                jit[jit_index] <= 27,
+                                                jit[jit_index] <= jit[jit_index] + 27 * JIT_OP,
                                                 StopThisScript()
                                 ],
                                 If (decode_i_type.funct3 == 0x2) [ # lw
-                                                jit[jit_index] <= 28,
+                                                jit[jit_index] <= jit[jit_index] + 28 * JIT_OP,
                                                 StopThisScript()
                                 ],
                                 If (decode_i_type.funct3 == 0x4) [ # lbu
-                                                jit[jit_index] <= 29,
+                                                jit[jit_index] <= jit[jit_index] + 29 * JIT_OP,
                                                 StopThisScript()
                                 ],
                                 If (decode_i_type.funct3 == 0x5) [ # lhu
-                                                jit[jit_index] <= 30,
+                                                jit[jit_index] <= jit[jit_index] + 30 * JIT_OP,
                                                 StopThisScript()
                                 ]
                 ],
                 If (locals.opcode == 0b0100011) [
                                 decode_s_type(inst).inline(),
                                 If (decode_s_type.funct3 == 0x0) [ # sb
-                                                jit[jit_index] <= 31,
+                                                jit[jit_index] <= jit[jit_index] + 31 * JIT_OP,
                                                 StopThisScript()
                                 ],
                                 If (decode_s_type.funct3 == 0x1) [ # sh
-                                                jit[jit_index] <= 32,
+                                                jit[jit_index] <= jit[jit_index] + 32 * JIT_OP,
                                                 StopThisScript()
                                 ],
                                 If (decode_s_type.funct3 == 0x2) [ # sw
-                                                jit[jit_index] <= 33,
+                                                jit[jit_index] <= jit[jit_index] + 33 * JIT_OP,
                                                 StopThisScript()
                                 ]
                 ],
                 If (locals.opcode == 0b1101111) [ # jal
                                 decode_j_type(inst).inline(),
-                                jit[jit_index] <= 34,
+                                jit[jit_index] <= jit[jit_index] + 34 * JIT_OP,
                                 StopThisScript()
                 ],
                 If (locals.opcode == 0b1100111) [ # jalr
                                 decode_i_type(inst).inline(),
                                 decode_i_type_signed(inst).inline(),
-                                jit[jit_index] <= 35,
+                                jit[jit_index] <= jit[jit_index] + 35 * JIT_OP,
                                 StopThisScript()
                 ],
                 If (locals.opcode == 0b0110111) [ # lui
                                 decode_u_type(inst).inline(),
-                                jit[jit_index] <= 36,
+                                jit[jit_index] <= jit[jit_index] + 36 * JIT_OP,
                                 StopThisScript()
                 ],
                 If (locals.opcode == 0b0010111) [ # auipc
                                 decode_u_type(inst).inline(),
-                                jit[jit_index] <= 37,
+                                jit[jit_index] <= jit[jit_index] + 37 * JIT_OP,
                                 StopThisScript()
                 ],
                 # If (locals.opcode == 0b0001111) [ # fence = nop
-                #                 jit[jit_index] <= 39,
+                #                 jit[jit_index] <= 39 * JIT_OP,
                 #                 StopThisScript()
                 # ],
-                If (locals.opcode == 0b1110011) [ # system
-                                jit[jit_index] <= 38,
-                                StopThisScript()
-                ],
-                jit[jit_index] <= 39
-]
-
-# freq = emu.new_list("_frequency", [0] * 37)
-
-@emu.proc_def(inline_only=True)
-def execute (locals, index): return [
-                locals.inst <= jit[index],
-                # freq[locals.inst] <= freq[locals.inst] + 1,
-                If (locals.inst == 6) [ # srli
-                                b_shift_right(regs[jit[index+2]], jit[index+3]).inline(),
-                                regs[jit[index+1]] <= result,
+                If (inst == 0x00000073) [ # ecall
+                                jit[jit_index] <= 56 * JIT_OP,
                                 StopThisScript()
                 ],
-                If (locals.inst == 7) [ # srai
-                                b_shift_right_arith(regs[jit[index+2]], jit[index+3] & 0x1f).inline(),
-                                regs[jit[index+1]] <= result,
+                If (inst == 0x10500073) [ # wfi
+                                jit[jit_index] <= 55 * JIT_OP,
                                 StopThisScript()
                 ],
-                If (locals.inst == 8) [ # slti
-                                less_than_signed(regs[jit[index+2]], jit[index+3]).inline(),
-                                regs[jit[index+1]] <= result,
-                                StopThisScript()
-                ],
-                If (locals.inst == 12) [ # bltu
-                                If (regs[jit[index+1]] < regs[jit[index+2]]) [
-                                                add(pc - 4, jit[index+3]).inline(),
-                                                pc <= result
+                If (locals.opcode == 0b1110011) [ # system
+                                decode_i_type_csr(inst).inline(),
+                                If (decode_i_type_csr.funct3 % 4 > 0) [
+                                                # csrrw, csrrs, csrrc to 57-59, then the immediate forms to 60-62
+                                                jit[jit_index] <= jit[jit_index]
+                                                                + (56 + decode_i_type_csr.funct3 - floor(decode_i_type_csr.funct3 / 4)) * JIT_OP
+                                ].Else [
+                                                jit[jit_index] <= 38 * JIT_OP
                                 ],
                                 StopThisScript()
                 ],
-                If (locals.inst == 37) [ # auipc
-                                add(pc - 4, jit[index+3]).inline(),
-                                regs[jit[index+1]] <= result,
-                                StopThisScript()
-                ],
-                If (locals.inst == 40) [ # mul
-                                multiply(regs[jit[index+2]], regs[jit[index+3]]).inline(),
-                                regs[jit[index+1]] <= result,
-                                StopThisScript()
-                ],
-                If (locals.inst == 41) [ # mulh
-                                toSigned32(regs[jit[index+2]]).inline(),
-                                locals.s1 <= result,
-                                toSigned32(regs[jit[index+3]]).inline(),
-                                multiply_upper(locals.s1, result).inline(),
-                                regs[jit[index+1]] <= result,
-                                StopThisScript()
-                ],
-                If (locals.inst == 42) [ # mulhu
-                                multiply_upper(regs[jit[index+2]], regs[jit[index+3]]).inline(),
-                                regs[jit[index+1]] <= result,
-                                StopThisScript()
-                ],
-                If (locals.inst == 43) [ # mulhisu
-                                toSigned32(regs[jit[index+2]]).inline(),
-                                multiply_upper(result, regs[jit[index+3]]).inline(),
-                                regs[jit[index+1]] <= result
-                ],
-                If (locals.inst == 44) [ # div
-                                toSigned32(regs[jit[index+2]]).inline(),
-                                locals.s1 <= result,
-                                toSigned32(regs[jit[index+3]]).inline(),
-                                divide(locals.s1, result).inline(),
-                                regs[jit[index+1]] <= result,
-                                StopThisScript()
-                ],
-                If (locals.inst == 45) [ # divu
-                                divide(regs[jit[index+2]], regs[jit[index+3]]).inline(),
-                                regs[jit[index+1]] <= result,
-                                StopThisScript()
-                ],
-                If (locals.inst == 46) [ # rem
-                                toSigned32(regs[jit[index+2]]).inline(),
-                                locals.s1 <= result,
-                                toSigned32(regs[jit[index+3]]).inline(),
-                                remainder(locals.s1, result).inline(),
-                                regs[jit[index+1]] <= result,
-                                StopThisScript()
-                ],
-                If (locals.inst == 47) [ # remu
-                                remainder(regs[jit[index+2]], regs[jit[index+3]]).inline(),
-                                regs[jit[index+1]] <= result,
+                jit[jit_index] <= 39 * JIT_OP
+]
+
+if RVC:
+
+                # Bit field of an instruction
+                def bits (inst, lo, width): return (inst >> lo) & ((1 << width) - 1)
+
+                # Compressed register field, for x8 to x15
+                def c_reg (inst, lo): return bits(inst, lo, 3) + 8
+
+                def c_entry (op, a, b, imm): return [
+                                jit[jit_index] <= op * JIT_OP + a * 32 + b,
+                                jit_imm[jit_index] <= imm,
                                 StopThisScript()
+                ]
+
+                # Decodes a 16-bit instruction into the same internal opcodes as the
+                # 32-bit instruction it expands to
+                @emu.proc_def()
+                def jit_compile_c (locals, inst): return [
+                                jit[jit_index] <= 0,
+                                locals.quadrant <= inst % 4,
+                                locals.funct3 <= inst >> 13,
+                                locals.rd <= bits(inst, 7, 5),
+                                locals.rs2 <= bits(inst, 2, 5),
+                                locals.imm <= bits(inst, 2, 5) - bits(inst, 12, 1) * 32, # sign-extended imm[5:0]
+                                If (locals.quadrant == 0) [
+                                                If ((locals.funct3 == 0).AND(inst > 0)) [ # c.addi4spn
+                                                                c_entry(1, c_reg(inst, 2), 2, (bits(inst, 6, 1) << 2) + (bits(inst, 5, 1) << 3)
+                                                                                + (bits(inst, 11, 2) << 4) + (bits(inst, 7, 4) << 6))
+                                                ],
+                                                If (locals.funct3 == 2) [ # c.lw
+                                                                c_entry(28, c_reg(inst, 2), c_reg(inst, 7), (bits(inst, 6, 1) << 2)
+                                                                                + (bits(inst, 10, 3) << 3) + (bits(inst, 5, 1) << 6))
+                                                ],
+                                                If (locals.funct3 == 6) [ # c.sw
+                                                                c_entry(33, c_reg(inst, 7), c_reg(inst, 2), (bits(inst, 6, 1) << 2)
+                                                                                + (bits(inst, 10, 3) << 3) + (bits(inst, 5, 1) << 6))
+                                                ]
+                                ],
+                                If (locals.quadrant == 1) [
+                                                If (locals.funct3 == 0) [ # c.addi
+                                                                c_entry(1, locals.rd, locals.rd, locals.imm)
+                                                ],
+                                                If ((locals.funct3 == 1).OR(locals.funct3 == 5)) [ # c.jal, c.j
+                                                                c_entry(34, 1 - floor(locals.funct3 / 4), 0, (bits(inst, 3, 3) << 1) + (bits(inst, 11, 1) << 4)
+                                                                                + (bits(inst, 2, 1) << 5) + (bits(inst, 7, 1) << 6) + (bits(inst, 6, 1) << 7)
+                                                                                + (bits(inst, 9, 2) << 8) + (bits(inst, 8, 1) << 10) - bits(inst, 12, 1) * 2048)
+                                                ],
+                                                If (locals.funct3 == 2) [ # c.li
+                                                                c_entry(1, locals.rd, 0, locals.imm)
+                                                ],
+                                                If ((locals.funct3 == 3).AND(locals.rd == 2)) [ # c.addi16sp
+                                                                c_entry(1, 2, 2, (bits(inst, 6, 1) << 4) + (bits(inst, 2, 1) << 5) + (bits(inst, 5, 1) << 6)
+                                                                                + (bits(inst, 3, 2) << 7) - bits(inst, 12, 1) * 512)
+                                                ],
+                                                If (locals.funct3 == 3) [ # c.lui
+                                                                c_entry(36, locals.rd, 0, (locals.imm * 4096 + 4294967296) % 4294967296)
+                                                ],
+                                                If (locals.funct3 == 4) [
+                                                                locals.rd <= c_reg(inst, 7),
+                                                                locals.funct2 <= bits(inst, 10, 2),
+                                                                If (locals.funct2 == 0) [ # c.srli
+                                                                                c_entry(6, locals.rd, locals.rd, locals.rs2)
+                                                                ],
+                                                                If (locals.funct2 == 1) [ # c.srai
+                                                                                c_entry(7, locals.rd, locals.rd, locals.rs2)
+                                                                ],
+                                                                If (locals.funct2 == 2) [ # c.andi
+                                                                                c_entry(4, locals.rd, locals.rd, (locals.imm + 4294967296) % 4294967296)
+                                                                ],
+                                                                locals.rs2 <= c_reg(inst, 2),
+                                                                dispatch_sparse(bits(inst, 5, 2), {
+                                                                                0: c_entry(17, locals.rd, locals.rd, locals.rs2), # c.sub
+                                                                                1: c_entry(18, locals.rd, locals.rd, locals.rs2), # c.xor
+                                                                                2: c_entry(19, locals.rd, locals.rd, locals.rs2), # c.or
+                                                                                3: c_entry(20, locals.rd, locals.rd, locals.rs2) # c.and
+                                                                })
+                                                ],
+                                                If (locals.funct3 > 5) [ # c.beqz, c.bnez
+                                                                c_entry(4 + locals.funct3, c_reg(inst, 7), 0, (bits(inst, 3, 2) << 1) + (bits(inst, 10, 2) << 3)
+                                                                                + (bits(inst, 2, 1) << 5) + (bits(inst, 5, 2) << 6) - bits(inst, 12, 1) * 256)
+                                                ]
+                                ],
+                                If (locals.quadrant == 2) [
+                                                If (locals.funct3 == 0) [ # c.slli
+                                                                c_entry(5, locals.rd, locals.rd, locals.rs2)
+                                                ],
+                                                If (locals.funct3 == 2) [ # c.lwsp
+                                                                c_entry(28, locals.rd, 2, (bits(inst, 4, 3) << 2) + (bits(inst, 12, 1) << 5) + (bits(inst, 2, 2) << 6))
+                                                ],
+                                                If (locals.funct3 == 4) [
+                                                                If (bits(inst, 12, 1) == 0) [
+                                                                                If (locals.rs2 == 0) [ # c.jr
+                                                                                                c_entry(35, 0, locals.rd, 0)
+                                                                                ],
+                                                                                c_entry(16, locals.rd, 0, locals.rs2) # c.mv
+                                                                ],
+                                                                If (locals.rs2 > 0) [ # c.add
+                                                                                c_entry(16, locals.rd, locals.rd, locals.rs2)
+                                                                ],
+                                                                If (locals.rd > 0) [ # c.jalr
+                                                                                c_entry(35, 1, locals.rd, 0)
+                                                                ],
+                                                                c_entry(38, 0, 0, 0) # c.ebreak
+                                                ],
+                                                If (locals.funct3 == 6) [ # c.swsp
+                                                                c_entry(33, 2, locals.rs2, (bits(inst, 9, 4) << 2) + (bits(inst, 7, 2) << 6))
+                                                ]
+                                ],
+                                jit[jit_index] <= 39 * JIT_OP
+                ]
+
+# Adjacent instruction pairs that jit_fuse merges into one internal opcode,
+# executed as the two original instructions back to back.
+# 48 (lui + addi into the same register) is folded into a single constant.
+FUSED_OPS = {
+                49: (36, 35), # lui or auipc + jalr
+                50: (1, 11), # addi + bne
+                51: (5, 16) # slli + add
+}
+
+# Called with jit_index at a freshly decoded instruction and prev at the
+# decoded instruction before it. Sets fused to 1 if the pair was merged
+# into prev.
+@emu.proc_def()
+def jit_fuse (locals, prev): return [
+                locals.fused <= 1,
+                locals.first <= floor(jit[prev] / JIT_OP),
+                locals.second <= floor(jit[jit_index] / JIT_OP),
+                locals.rd <= (jit[prev] % JIT_OP) / 32,
+                If ((locals.first == 36).AND(locals.second == 1)
+                                .AND(jit[jit_index] % JIT_OP == locals.rd * 32 + locals.rd)) [ # lui + addi
+                                add(jit_imm[prev], jit_imm[jit_index]).inline(),
+                                jit_imm[prev] <= result,
+                                jit[prev] <= jit[prev] % JIT_OP + 48 * JIT_OP,
+                                StopThisScript()
+                ],
+                [
+                                If ((locals.first == first).AND(locals.second == second)) [
+                                                jit[prev] <= jit[prev] % JIT_OP + op * JIT_OP,
+                                                StopThisScript()
+                                ]
+                for op, (first, second) in FUSED_OPS.items()],
+                locals.fused <= 0
+]
+
+if PROFILE_OPCODES:
+                freq = emu.new_list("_frequency", [0] * 64, monitor=[0, 0, 120, 300])
+
+# Register fields of a packed _JIT_CACHE entry. These are only used as list
+# indices, which Scratch floors, so the fractional part can be left in.
+def jit_a (entry): return entry / 32 % 32
+def jit_b (entry): return entry % 32
+
+def execute_ops (index, entry): return {
+                1: [ # addi
+                                add(regs[jit_b(entry)], jit_imm[index]).inline(),
+                                regs[jit_a(entry)] <= result
                 ],
-                If (locals.inst == 34) [ # jal
-                                add(pc - 4, jit[index+3]).inline(),
-                                regs[jit[index+1]] <= pc,
-                                pc <= result,
-                                StopThisScript()
+                2: [ # xori
+                                b_xor(regs[jit_b(entry)], jit_imm[index]).inline(),
+                                regs[jit_a(entry)] <= result
                 ],
-                If (locals.inst == 35) [ # jalr
-                                add(regs[jit[index+2]], jit[index+3]).inline(),
-                                regs[jit[index+1]] <= pc,
-                                pc <= (result >> 1) << 1,
-                                StopThisScript()
+                3: [ # ori
+                                b_or(regs[jit_b(entry)], jit_imm[index]).inline(),
+                                regs[jit_a(entry)] <= result
                 ],
-                If (locals.inst == 36) [ # lui
-                                regs[jit[index+1]] <= jit[index+3],
-                                StopThisScript()
+                4: [ # andi
+                                b_and(regs[jit_b(entry)], jit_imm[index]).inline(),
+                                regs[jit_a(entry)] <= result
                 ],
-                If (locals.inst == 1) [ # addi
-                                add(regs[jit[index+2]], jit[index+3]).inline(),
-                                regs[jit[index+1]] <= result,
-                                StopThisScript()
+                5: [ # slli (imm holds 2 ** shamt)
+                                regs[jit_a(entry)] <= (regs[jit_b(entry)] * jit_imm[index]) % 4294967296
                 ],
-                If (locals.inst == 2) [ # xori
-                                b_xor(regs[jit[index+2]], jit[index+3]).inline(),
-                                regs[jit[index+1]] <= result,
-                                StopThisScript()
+                6: [ # srli (imm holds 2 ** shamt)
+                                regs[jit_a(entry)] <= floor(regs[jit_b(entry)] / jit_imm[index])
                 ],
-                If (locals.inst == 3) [ # ori
-                                b_or(regs[jit[index+2]], jit[index+3]).inline(),
-                                regs[jit[index+1]] <= result,
-                                StopThisScript()
+                7: [ # srai (imm holds 2 ** shamt)
+                                regs[jit_a(entry)] <= floor(signed32(regs[jit_b(entry)]) / jit_imm[index]) % 4294967296
                 ],
-                If (locals.inst == 4) [ # andi
-                                b_and(regs[jit[index+2]], jit[index+3]).inline(),
-                                regs[jit[index+1]] <= result,
-                                StopThisScript()
+                8: [ # slti (imm holds imm + 2 ** 31)
+                                less_than_unsigned(bias32(regs[jit_b(entry)]), jit_imm[index]).inline(),
+                                regs[jit_a(entry)] <= result
                 ],
-                If (locals.inst == 5) [ # slli
-                                b_shift_left(regs[jit[index+2]], jit[index+3]).inline(),
-                                regs[jit[index+1]] <= result,
-                                StopThisScript()
+                9: [ # sltiu
+                                less_than_unsigned(regs[jit_b(entry)], jit_imm[index]).inline(),
+                                regs[jit_a(entry)] <= result
                 ],
-                If (locals.inst == 9) [ # sltiu
-                                less_than_unsigned(regs[jit[index+2]], jit[index+3]).inline(),
-                                regs[jit[index+1]] <= result,
-                                StopThisScript()
+                10: [ # beq
+                                If (regs[jit_a(entry)] == regs[jit_b(entry)]) [
+                                                pc <= jit_imm[index]
+                                ]
                 ],
-                If (locals.inst == 10) [ # beq
-                                If (regs[jit[index+1]] == regs[jit[index+2]]) [
-                                                add(pc - 4, jit[index+3]).inline(),
-                                                pc <= result,
-                                ],
-                                StopThisScript()
+                11: [ # bne
+                                If (regs[jit_a(entry)] != regs[jit_b(entry)]) [
+                                                pc <= jit_imm[index]
+                                ]
                 ],
-                If (locals.inst == 11) [ # bne
-                                If (regs[jit[index+1]] != regs[jit[index+2]]) [
-                                                add(pc - 4, jit[index+3]).inline(),
-                                                pc <= result
-                                ],
-                                StopThisScript()
+                12: [ # bltu
+                                If (regs[jit_a(entry)] < regs[jit_b(entry)]) [
+                                                pc <= jit_imm[index]
+                                ]
                 ],
-                If (locals.inst == 13) [ # bgeu
-                                If ((regs[jit[index+1]] < regs[jit[index+2]]).NOT()) [
-                                                add(pc - 4, jit[index+3]).inline(),
-                                                pc <= result
-                                ],
-                                StopThisScript()
+                13: [ # bgeu
+                                If ((regs[jit_a(entry)] < regs[jit_b(entry)]).NOT()) [
+                                                pc <= jit_imm[index]
+                                ]
                 ],
-                If (locals.inst == 14) [ # blt
-                                toSigned32(regs[jit[index+1]]).inline(),
-                                locals.srs1 <= result,
-                                toSigned32(regs[jit[index+2]]).inline(),
-                                If (locals.srs1 < result) [
-                                                add(pc - 4, jit[index+3]).inline(),
-                                                pc <= result
-                                ],
-                                StopThisScript()
+                14: [ # blt
+                                If (bias32(regs[jit_a(entry)]) < bias32(regs[jit_b(entry)])) [
+                                                pc <= jit_imm[index]
+                                ]
                 ],
-                If (locals.inst == 15) [ # bge
-                                toSigned32(regs[jit[index+1]]).inline(),
-                                locals.srs1 <= result,
-                                toSigned32(regs[jit[index+2]]).inline(),
-                                If ((locals.srs1 < result).NOT()) [
-                                                add(pc - 4, jit[index+3]).inline(),
-                                                pc <= result
-                                ],
-                                StopThisScript()
+                15: [ # bge
+                                If ((bias32(regs[jit_a(entry)]) < bias32(regs[jit_b(entry)])).NOT()) [
+                                                pc <= jit_imm[index]
+                                ]
                 ],
-                If (locals.inst == 16) [ # add
-                                add(regs[jit[index+2]], regs[jit[index+3]]).inline(),
-                                regs[jit[index+1]] <= result,
-                                StopThisScript()
+                16: [ # add
+                                add(regs[jit_b(entry)], regs[jit_imm[index]]).inline(),
+                                regs[jit_a(entry)] <= result
                 ],
-                If (locals.inst == 17) [ # sub
-                                sub(regs[jit[index+2]], regs[jit[index+3]]).inline(),
-                                regs[jit[index+1]] <= result,
-                                StopThisScript()
+                17: [ # sub
+                                sub(regs[jit_b(entry)], regs[jit_imm[index]]).inline(),
+                                regs[jit_a(entry)] <= result
                 ],
-                If (locals.inst == 18) [ # xor
-                                b_xor(regs[jit[index+2]], regs[jit[index+3]]).inline(),
-                                regs[jit[index+1]] <= result,
-                                StopThisScript()
+                18: [ # xor
+                                b_xor(regs[jit_b(entry)], regs[jit_imm[index]]).inline(),
+                                regs[jit_a(entry)] <= result
                 ],
-                If (locals.inst == 19) [ # or
-                                b_or(regs[jit[index+2]], regs[jit[index+3]]).inline(),
-                                regs[jit[index+1]] <= result,
-                                StopThisScript()
+                19: [ # or
+                                b_or(regs[jit_b(entry)], regs[jit_imm[index]]).inline(),
+                                regs[jit_a(entry)] <= result
                 ],
-                If (locals.inst == 20) [ # and
-                                b_and(regs[jit[index+2]], regs[jit[index+3]]).inline(),
-                                regs[jit[index+1]] <= result,
-                                StopThisScript()
+                20: [ # and
+                                b_and(regs[jit_b(entry)], regs[jit_imm[index]]).inline(),
+                                regs[jit_a(entry)] <= result
                 ],
-                If (locals.inst == 21) [ # sll
-                                b_shift_left(regs[jit[index+2]], regs[jit[index+3]] & 0x1f).inline(),
-                                regs[jit[index+1]] <= result,
-                                StopThisScript()
+                21: [ # sll
+                                b_shift_left(regs[jit_b(entry)], regs[jit_imm[index]] & 0x1f).inline(),
+                                regs[jit_a(entry)] <= result
                 ],
-                If (locals.inst == 22) [ # srl
-                                b_shift_right(regs[jit[index+2]], regs[jit[index+3]] & 0x1f).inline(),
-                                regs[jit[index+1]] <= result,
-                                StopThisScript()
+                22: [ # srl
+                                b_shift_right(regs[jit_b(entry)], regs[jit_imm[index]] & 0x1f).inline(),
+                                regs[jit_a(entry)] <= result
                 ],
-                If (locals.inst == 23) [ # sra
-                                b_shift_right_arith(regs[jit[index+2]], regs[jit[index+3]] & 0x1f).inline(),
-                                regs[jit[index+1]] <= result,
-                                StopThisScript()
+                23: [ # sra
+                                b_shift_right_arith(regs[jit_b(entry)], regs[jit_imm[index]] & 0x1f).inline(),
+                                regs[jit_a(entry)] <= result
                 ],
-                If (locals.inst == 24) [ # slt
-                                less_than_signed(regs[jit[index+2]], regs[jit[index+3]]).inline(),
-                                regs[jit[index+1]] <= result,
-                                StopThisScript()
+                24: [ # slt
+                                less_than_signed(regs[jit_b(entry)], regs[jit_imm[index]]).inline(),
+                                regs[jit_a(entry)] <= result
                 ],
-                If (locals.inst == 25) [ # sltu
-                                less_than_unsigned(regs[jit[index+2]], regs[jit[index+3]]).inline(),
-                                regs[jit[index+1]] <= result,
-                                StopThisScript()
+                25: [ # sltu
+                                less_than_unsigned(regs[jit_b(entry)], regs[jit_imm[index]]).inline(),
+                                regs[jit_a(entry)] <= result
                 ],
-                add(regs[jit[index+2]], jit[index+3]).inline(),
-                If (locals.inst == 26) [ # lb
+                26: [ # lb
+                                add(regs[jit_b(entry)], jit_imm[index]).inline(),
                                 bus_load8(result).inline(),
                                 toSigned8(bus_result).inline(),
                                 toUnsigned32(result).inline(),
-                                regs[jit[index+1]] <= result,
-                                StopThisScript()
+                                regs[jit_a(entry)] <= result
                 ],
-                If (locals.inst == 27) [ # lh
+                27: [ # lh
+                                add(regs[jit_b(entry)], jit_imm[index]).inline(),
                                 bus_load16(result).inline(),
                                 toSigned16(bus_result).inline(),
                                 toUnsigned32(result).inline(),
-                                regs[jit[index+1]] <= result,
-                                StopThisScript()
+                                regs[jit_a(entry)] <= result
                 ],
-                If (locals.inst == 28) [ # lw
+                28: [ # lw
+                                add(regs[jit_b(entry)], jit_imm[index]).inline(),
                                 bus_load32(result).inline(),
-                                regs[jit[index+1]] <= bus_result,
-                                StopThisScript()
+                                regs[jit_a(entry)] <= bus_result
                 ],
-                If (locals.inst == 29) [ # lbu
+                29: [ # lbu
+                                add(regs[jit_b(entry)], jit_imm[index]).inline(),
                                 bus_load8(result).inline(),
-                                regs[jit[index+1]] <= bus_result,
-                                StopThisScript()
+                                regs[jit_a(entry)] <= bus_result
                 ],
-                If (locals.inst == 30) [ # lhu
+                30: [ # lhu
+                                add(regs[jit_b(entry)], jit_imm[index]).inline(),
                                 bus_load16(result).inline(),
-                                regs[jit[index+1]] <= bus_result,
-                                StopThisScript()
+                                regs[jit_a(entry)] <= bus_result
+                ],
+                31: [ # sb
+                                add(regs[jit_a(entry)], jit_imm[index]).inline(),
+                                bus_store8(result, regs[jit_b(entry)]).inline()
+                ],
+                32: [ # sh
+                                add(regs[jit_a(entry)], jit_imm[index]).inline(),
+                                execute.value <= regs[jit_b(entry)],
+                                bus_store16(result, execute.value).inline()
+                ],
+                33: [ # sw
+                                add(regs[jit_a(entry)], jit_imm[index]).inline(),
+                                execute.value <= regs[jit_b(entry)],
+                                bus_store32(result, execute.value).inline()
+                ],
+                34: [ # jal
+                                regs[jit_a(entry)] <= pc,
+                                pc <= jit_imm[index]
+                ],
+                35: [ # jalr
+                                add(regs[jit_b(entry)], jit_imm[index]).inline(),
+                                regs[jit_a(entry)] <= pc,
+                                pc <= (result >> 1) << 1
+                ],
+                36: [ # lui, and auipc once jit_block has added its address
+                                regs[jit_a(entry)] <= jit_imm[index]
+                ],
+                38: [ # system
+                                execute.running <= 0
+                ],
+                39: [], # fence / unknown
+                40: [ # mul
+                                multiply(regs[jit_b(entry)], regs[jit_imm[index]]).inline(),
+                                regs[jit_a(entry)] <= result
+                ],
+                41: [ # mulh
+                                toSigned32(regs[jit_b(entry)]).inline(),
+                                execute.s1 <= result,
+                                toSigned32(regs[jit_imm[index]]).inline(),
+                                multiply_upper(execute.s1, result).inline(),
+                                regs[jit_a(entry)] <= result
+                ],
+                42: [ # mulhu
+                                multiply_upper(regs[jit_b(entry)], regs[jit_imm[index]]).inline(),
+                                regs[jit_a(entry)] <= result
+                ],
+                43: [ # mulhsu
+                                toSigned32(regs[jit_b(entry)]).inline(),
+                                multiply_upper(result, regs[jit_imm[index]]).inline(),
+                                regs[jit_a(entry)] <= result
+                ],
+                44: [ # div (rounds towards zero)
+                                If (regs[jit_imm[index]] == 0) [
+                                                regs[jit_a(entry)] <= 0xffffffff
+                                ].Else [
+                                                execute.s1 <= signed32(regs[jit_b(entry)]) / signed32(regs[jit_imm[index]]),
+                                                If (execute.s1 < 0) [
+                                                                regs[jit_a(entry)] <= ceil(execute.s1) % 4294967296
+                                                ].Else [
+                                                                regs[jit_a(entry)] <= floor(execute.s1) % 4294967296
+                                                ]
+                                ]
                 ],
-                add(regs[jit[index+1]], jit[index+3]).inline(),
-                If (locals.inst == 31) [ # sb
-                                bus_store8(result, regs[jit[index+2]]).inline(),
-                                StopThisScript()
+                45: [ # divu
+                                If (regs[jit_imm[index]] == 0) [
+                                                regs[jit_a(entry)] <= 0xffffffff
+                                ].Else [
+                                                divide(regs[jit_b(entry)], regs[jit_imm[index]]).inline(),
+                                                regs[jit_a(entry)] <= result
+                                ]
                 ],
-                If (locals.inst == 32) [ # sh
-                                locals.value <= regs[jit[index+2]],
-                                bus_store16(result, locals.value).inline(),
-                                StopThisScript()
+                46: [ # rem (takes the sign of the dividend)
+                                If (regs[jit_imm[index]] == 0) [
+                                                regs[jit_a(entry)] <= regs[jit_b(entry)]
+                                ].Else [
+                                                execute.s1 <= signed32(regs[jit_b(entry)]),
+                                                execute.s2 <= abs(execute.s1) % abs(signed32(regs[jit_imm[index]])),
+                                                If (execute.s1 < 0) [
+                                                                regs[jit_a(entry)] <= (0 - execute.s2) % 4294967296
+                                                ].Else [
+                                                                regs[jit_a(entry)] <= execute.s2
+                                                ]
+                                ]
                 ],
-                If (locals.inst == 33) [ # sw
-                                locals.value <= regs[jit[index+2]],
-                                bus_store32(result, locals.value).inline(),
-                                StopThisScript()
+                47: [ # remu
+                                If (regs[jit_imm[index]] == 0) [
+                                                regs[jit_a(entry)] <= regs[jit_b(entry)]
+                                ].Else [
+                                                remainder(regs[jit_b(entry)], regs[jit_imm[index]]).inline(),
+                                                regs[jit_a(entry)] <= result
+                                ]
+                ],
+                52: [ # mv (addi/ori/xori 0, andi -1)
+                                regs[jit_a(entry)] <= regs[jit_b(entry)]
+                ],
+                53: [ # andi with a low mask (imm holds mask + 1)
+                                regs[jit_a(entry)] <= regs[jit_b(entry)] % jit_imm[index]
+                ],
+                54: [ # not (xori -1)
+                                regs[jit_a(entry)] <= 4294967295 - regs[jit_b(entry)]
                 ],
-                If (locals.inst == 38) [
-                                locals.running <= 0
+                55: [ # wfi
+                                waiting <= 1,
+                                execute.running <= 0
+                ],
+                56: [ # ecall
+                                syscall(),
+                                If (syscall.end_frame == 1) [
+                                                execute.running <= 0
+                                ]
+                ],
+                57: [ # csrrw
+                                csr_access(jit_imm[index], regs[jit_b(entry)], 1),
+                                regs[jit_a(entry)] <= result
+                ],
+                58: [ # csrrs
+                                csr_access(jit_imm[index], regs[jit_b(entry)], 2),
+                                regs[jit_a(entry)] <= result
+                ],
+                59: [ # csrrc
+                                csr_access(jit_imm[index], regs[jit_b(entry)], 3),
+                                regs[jit_a(entry)] <= result
+                ],
+                60: [ # csrrwi (the rs1 field holds the immediate)
+                                csr_access(jit_imm[index], jit_b(entry), 1),
+                                regs[jit_a(entry)] <= result
+                ],
+                61: [ # csrrsi
+                                csr_access(jit_imm[index], jit_b(entry), 2),
+                                regs[jit_a(entry)] <= result
+                ],
+                62: [ # csrrci
+                                csr_access(jit_imm[index], jit_b(entry), 3),
+                                regs[jit_a(entry)] <= result
                 ]
+}
+
+# Both halves of a fused pair are 32-bit instructions
+def fused_ops (index, entry):
+                first = execute_ops(index, entry)
+                second = execute_ops(index + INST_ENTRIES, execute.next)
+                ops = {
+                                48: [ # lui + addi
+                                                regs[jit_a(entry)] <= jit_imm[index],
+                                                pc <= pc + 4,
+                                                jit_index.changeby(INST_ENTRIES)
+                                ]
+                }
+                for op, (a, b) in FUSED_OPS.items():
+                                ops[op] = [
+                                                first[a],
+                                                pc <= pc + 4,
+                                                execute.next <= jit[index + INST_ENTRIES],
+                                                second[b],
+                                                jit_index.changeby(INST_ENTRIES)
+                                ]
+                return ops
+
+@emu.proc_def(inline_only=True)
+def execute (locals, index): return [
+                locals.inst <= jit[index],
+                freq[floor(locals.inst / JIT_OP)] <= freq[floor(locals.inst / JIT_OP)] + 1 if PROFILE_OPCODES else [],
+                dispatch(locals.inst, execute_ops(index, locals.inst) | fused_ops(index, locals.inst), OPCODE_PROFILE, JIT_OP)
 ]
 
 @emu.proc_def()
@@ -1090,7 +2230,7 @@ def breakpoint (locals): return [
                 If (execute.matched == 0) [
                                 uart.append("* Unknown instruction encountered")
                 ],
-                If (pc - DRAM_BASE > DRAM_SIZE) [
+                If (pc - DRAM_BASE > CODE_SIZE) [
                                 uart.append("* PC exceeded DRAM size"),
                                 uart.append(Literal("PC: ").join(pc)),
                                 uart.append(Literal("DRAM_BASE: ").join(DRAM_BASE)),
@@ -1107,10 +2247,8 @@ def breakpoint (locals): return [
                 to_hex(bus_result),
                 uart.append(Literal("bus: ").join(to_hex.result)),
                 uart.append(Literal("tick: ").join(ticks)),
-                uart.append(Literal("jit0: ").join(jit[jit_index])),
-                uart.append(Literal("jit1: ").join(jit[jit_index+1])),
-                uart.append(Literal("jit2: ").join(jit[jit_index+2])),
-                uart.append(Literal("jit3: ").join(jit[jit_index+3])),
+                uart.append(Literal("jit: ").join(jit[jit_index])),
+                uart.append(Literal("jit imm: ").join(jit_imm[jit_index])),
                 uart.append("--- Registers ---"),
                 locals.i[:regs.len():1] >> [
                                 to_hex(regs[locals.i]),
@@ -1119,93 +2257,412 @@ def breakpoint (locals): return [
                 StopAll()
 ]
 
+### Basic blocks
+
+# Upper bound on the number of instructions decoded into one block
+BLOCK_MAX = 64
+
+# Internal opcodes that may transfer control or end the frame (branches,
+# jal, jalr, system, wfi, ecall), and the CSR ops, so that a counter read
+# comes last in its block and _TICKS is exact there
+BLOCK_END_OPS = [10, 11, 12, 13, 14, 15, 34, 35, 38, 55, 56, 57, 58, 59, 60, 61, 62]
+
+# Internal opcodes whose immediate is relative to the instruction's address
+# (branches, jal and auipc). jit_block makes it absolute.
+PC_RELATIVE_OPS = [10, 11, 12, 13, 14, 15, 34, 37]
+
+# Internal opcodes whose only effect is writing a destination register
+ALU_OPS = list(range(1, 10)) + list(range(16, 26)) + [36, 37] + list(range(40, 48))
+
+# Internal opcodes that write a destination register (the first field holds rd)
+RD_WRITE_OPS = ALU_OPS + list(range(26, 31)) + list(range(57, 63))
+
+def one_of (value, ids):
+                ids = sorted(ids)
+                runs = []
+                for i in ids:
+                                if runs and runs[-1][1] == i - 1:
+                                                runs[-1][1] = i
+                                else:
+                                                runs.append([i, i])
+                cond = None
+                for lo, hi in runs:
+                                if lo == hi:
+                                                term = value == lo
+                                else:
+                                                term = (value > lo - 1).AND(value < hi + 1)
+                                cond = term if cond is None else cond.OR(term)
+                return cond
+
+# Rewrites the instruction just decoded at jit_index into a cheaper internal
+# opcode where its operands allow: ALU writes to x0 become no-ops, shift
+# amounts are turned into powers of two, slti immediates are biased by 2^31,
+# and some immediate logic ops become moves, constants or a modulo.
+@emu.proc_def()
+def jit_specialize (locals): return [
+                locals.inst <= floor(jit[jit_index] / JIT_OP),
+                locals.fields <= jit[jit_index] % JIT_OP,
+                locals.imm <= jit_imm[jit_index],
+                If (one_of(locals.inst, ALU_OPS).AND(locals.fields < 32)) [ # rd = x0
+                                jit[jit_index] <= 39 * JIT_OP,
+                                StopThisScript()
+                ],
+                If (one_of(locals.inst, [5, 6, 7])) [ # slli, srli, srai
+                                jit_imm[jit_index] <= base2_lut[locals.imm % 32],
+                                StopThisScript()
+                ],
+                If (locals.inst == 8) [ # slti
+                                jit_imm[jit_index] <= bias32(locals.imm),
+                                StopThisScript()
+                ],
+                If ((one_of(locals.inst, [1, 2, 3]).AND(locals.imm == 0))
+                                .OR((locals.inst == 4).AND(locals.imm == 0xffffffff))) [
+                                jit[jit_index] <= locals.fields + 52 * JIT_OP,
+                                StopThisScript()
+                ],
+                If ((locals.inst == 4).AND(one_of(locals.imm, [2 ** k - 1 for k in range(1, 12)]))) [
+                                jit_imm[jit_index] <= locals.imm + 1,
+                                jit[jit_index] <= locals.fields + 53 * JIT_OP,
+                                StopThisScript()
+                ],
+                If ((locals.inst == 2).AND(locals.imm == 0xffffffff)) [
+                                jit[jit_index] <= locals.fields + 54 * JIT_OP,
+                                StopThisScript()
+                ],
+                If ((locals.inst == 4).AND(locals.imm == 0)) [
+                                jit[jit_index] <= floor(locals.fields / 32) * 32 + 36 * JIT_OP, # li 0
+                                StopThisScript()
+                ],
+                If ((locals.inst == 3).AND(locals.imm == 0xffffffff)) [
+                                jit[jit_index] <= floor(locals.fields / 32) * 32 + 36 * JIT_OP # li -1
+                ]
+]
+
+# Fuses the instruction at jit_index with the one at prev where possible, and
+# moves prev on to the next candidate
+def fuse_with (prev): return If (prev == -1) [
+                prev <= jit_index
+].Else [
+                jit_fuse(prev),
+                If (jit_fuse.fused == 1) [
+                                prev <= -1
+                ].Else [
+                                prev <= jit_index
+                ]
+]
+
+# Decodes the straight-line run starting at pc, up to and including the next
+# control transfer. The block length is kept in _JIT_BLOCKS at the first
+# instruction; 0 means no block has been formed there.
+# Writes to x0 also end a block, since x0 is only cleared on block entry.
 @emu.proc_def()
+def jit_block (locals): return [
+                locals.head <= jit_index,
+                locals.addr <= pc,
+                locals.count <= 0,
+                locals.done <= 0,
+                locals.prev <= -1,
+                RepeatUntil (locals.done == 1) [
+                                fetch(locals.addr).inline(),
+                                code_pages[(locals.addr - DRAM_BASE) / CODE_PAGE] <= 1,
+                                [
+                                                If (bus_result % 4 == 3) [
+                                                                jit_compile(bus_result),
+                                                                locals.size <= 4
+                                                ].Else [
+                                                                jit_compile_c(bus_result % 65536),
+                                                                locals.size <= 2
+                                                ],
+                                                sizes[jit_index] <= locals.size
+                                ] if RVC else jit_compile(bus_result),
+                                jit_specialize(),
+                                locals.inst <= floor(jit[jit_index] / JIT_OP),
+                                If (one_of(locals.inst, PC_RELATIVE_OPS)) [
+                                                add(locals.addr, jit_imm[jit_index]).inline(),
+                                                jit_imm[jit_index] <= result,
+                                                If (locals.inst == 37) [ # auipc is now a constant, as lui
+                                                                jit[jit_index] <= jit[jit_index] - JIT_OP,
+                                                                locals.inst <= 36
+                                                ]
+                                ],
+                                If (locals.size == 2) [
+                                                locals.prev <= -1 # only 32-bit instructions are fused
+                                ].Else [
+                                                fuse_with(locals.prev)
+                                ] if RVC else fuse_with(locals.prev),
+                                locals.count.changeby(1),
+                                locals.addr.changeby(locals.size if RVC else 4),
+                                If (one_of(locals.inst, BLOCK_END_OPS)
+                                                .OR(one_of(locals.inst, RD_WRITE_OPS).AND(jit[jit_index] % JIT_OP < 32))
+                                                .OR(locals.count == BLOCK_MAX)
+                                                .OR(locals.addr - DRAM_BASE > CODE_SIZE - 4)) [
+                                                locals.done <= 1
+                                ],
+                                jit_index.changeby(locals.size / 2 if RVC else 1)
+                ],
+                jit_index <= locals.head,
+                blocks[jit_index] <= (locals.count * BLOCK_SPAN + (locals.addr - pc) / 2 if RVC else locals.count)
+]
+
+@emu.proc_def(inline_only=True)
 def tick (locals): return [
-                ticks <= ticks + 1,
-                If ((pc - DRAM_BASE > DRAM_SIZE).OR(pc == 0)) [
+                If ((pc - DRAM_BASE > CODE_SIZE).OR(pc == 0)) [
                                 breakpoint()   
                 ],
                 regs[0] <= 0,
-                jit_index <= (pc - DRAM_BASE) * 4,
-                If (jit[jit_index] == 0) [
-                                fetch(pc).inline(),
-                                jit_compile(bus_result),
+                jit_index <= (pc - DRAM_BASE) / JIT_STRIDE,
+                If (blocks[jit_index] == 0) [
+                                jit_block()
                 ],
                 breakpoint.old_pc <= pc,
-                pc <= pc + 4,
-                execute(jit_index).inline()
+                locals.head <= jit_index,
+                [
+                                locals.end <= jit_index + blocks[jit_index] % BLOCK_SPAN,
+                                ticks <= ticks + floor(blocks[jit_index] / BLOCK_SPAN)
+                ] if RVC else [
+                                locals.end <= jit_index + blocks[jit_index],
+                                ticks <= ticks + blocks[jit_index]
+                ],
+                RepeatUntil (jit_index == locals.end) [
+                                If (jit[jit_index] == 0) [
+                                                # Overwritten since the block was formed: end the block
+                                                # here and have both blocks decoded again.
+                                                [
+                                                                locals.i <= jit_index,
+                                                                RepeatUntil (locals.i > locals.end - 1) [
+                                                                                ticks.changeby(-1),
+                                                                                locals.i <= locals.i + sizes[locals.i] / 2
+                                                                ]
+                                                ] if RVC else ticks <= ticks - (locals.end - jit_index),
+                                                blocks[locals.head] <= 0,
+                                                blocks[jit_index] <= 0,
+                                                locals.end <= jit_index
+                                ].Else [
+                                                [
+                                                                locals.size <= sizes[jit_index],
+                                                                pc <= pc + locals.size,
+                                                                execute(jit_index).inline(),
+                                                                jit_index <= jit_index + locals.size / 2
+                                                ] if RVC else [
+                                                                pc <= pc + 4,
+                                                                execute(jit_index).inline(),
+                                                                jit_index <= jit_index + 1
+                                                ]
+                                ]
+                ]
+]
+
+# Moves the cursor to the start of the next row, scrolling the ring by one
+# row at the bottom of the screen
+@emu.proc_def()
+def new_line (locals): return [
+                x <= 0,
+                y.changeby(1),
+                If (y == ROWS) [
+                                y <= ROWS - 1,
+                                top <= (top + 1) % ROWS,
+                                scrolled <= 1
+                ],
+                clear_row().inline()
 ]
 
+# Stamps are skipped once the console has scrolled this frame, since draw
+# repaints the whole screen afterwards.
 @emu.proc_def()
 def draw_char (locals, code): return [
                 If (code == 10) [
-                                y.changeby(1),
-                                x <= 0,
-                                SetXYPos(-240, -y * 16 + 180),
+                                new_line(),
                                 StopThisScript()
                 ],
                 If (code == 8) [
                                 If (x > 0) [
                                                 x.changeby(-1)
                                 ],
-                                SetXYPos(x * 8 - 240, -y * 16 + 180),
-                                SetCostume(Literal(32 + 2)),
-                                Stamp(),
+                                console[((top + y) % ROWS) * COLS + x] <= 0,
+                                If (scrolled == 0) [
+                                                SetXYPos(x * 8 - 240, -y * 16 + 180),
+                                                SetCostume(Literal(32 + 2)),
+                                                Stamp()
+                                ],
                                 StopThisScript()
                 ],
-                SetCostume(code + 2),
-                Stamp(),
-                x.changeby(1),
-                SetXYPos(x * 8 - 240, -y * 16 + 180)
-]
-
-@emu.proc_def(inline_only=True)
-def append (locals): return [
-                RepeatUntil (uart.len() == 0) [
-                                draw_char(uart[0]),
-                                uart.delete_at(0)
+                If (x == COLS) [
+                                new_line()
                 ],
-                SetCostume("cursor")
+                console[((top + y) % ROWS) * COLS + x] <= code,
+                If (scrolled == 0) [
+                                SetXYPos(x * 8 - 240, -y * 16 + 180),
+                                SetCostume(code + 2),
+                                Stamp()
+                ],
+                x.changeby(1)
 ]
 
 @emu.proc_def(inline_only=True)
 def redraw (locals): return [
-                clear_screen(),
-                locals.i[:history.len():1] >> [
-                                draw_char(history[locals.i])
-                ],
-                SetCostume("cursor")
+                clear_pen().inline(),
+                locals.row <= 0,
+                Repeat (ROWS) [
+                                locals.base <= ((top + locals.row) % ROWS) * COLS,
+                                locals.col <= 0,
+                                Repeat (COLS) [
+                                                locals.code <= console[locals.base + locals.col],
+                                                If (locals.code > 0) [
+                                                                SetXYPos(locals.col * 8 - 240, -locals.row * 16 + 180),
+                                                                SetCostume(locals.code + 2),
+                                                                Stamp()
+                                                ],
+                                                locals.col.changeby(1)
+                                ],
+                                locals.row.changeby(1)
+                ]
 ]
 
 @emu.proc_def()
 def draw (locals): return [
-                SetXYPos(x * 8 - 240, -y * 16 + 180),
                 If (uart.len() > 0) [
-                                locals.scroll <= newlines - 20,
-                                If (locals.scroll > 0) [
-                                                redraw().inline(),
-                                                newlines <= 20
-                                ].Else [
-                                                append().inline()
+                                scrolled <= 0,
+                                locals.i[:uart.len():1] >> [
+                                                draw_char(uart[locals.i])
+                                ],
+                                uart.delete_all(),
+                                If (scrolled == 1) [
+                                                redraw().inline()
                                 ]
                 ],
-                SetXYPos(x * 8 - 240, -y * 16 + 180)
+                If ((tiles_pending == 1).AND(tile_map > 0)) [
+                                draw_tiles()
+                ],
+                SetXYPos(x * 8 - 240, -y * 16 + 180),
+                SetCostume("cursor")
 ]
 
+### Snapshots
+
+# Keys that save the machine state to _SNAPSHOT and restore it. Both run
+# between frames, when every instruction has completed.
+SAVE_KEY = "left arrow"
+RESTORE_KEY = "right arrow"
+
 @emu.proc_def()
-def loop (locals): return [
-                execute.running <= 1,
-                Forever [
-                                tick(),
-                                If (execute.running == 0) [
-                                                draw(),
-                                                StopThisScript()
+def save_snapshot (locals): return [
+                snapshot.delete_all(),
+                snapshot.append(pc),
+                snapshot.append(ticks),
+                snapshot.append(top),
+                snapshot.append(x),
+                snapshot.append(y),
+                snapshot.append(mtimecmp_lo),
+                snapshot.append(mtimecmp_hi),
+                snapshot.append(tile_map),
+                [[
+                                locals.i <= 0,
+                                Repeat (lst.len()) [
+                                                snapshot.append(lst[locals.i]),
+                                                locals.i.changeby(1)
+                                ]
+                ] for lst, size in state_lists],
+                [[
+                                snapshot_dram.delete_all(),
+                                locals.i <= 0,
+                                Repeat (lst.len()) [
+                                                snapshot_dram.append(lst[locals.i]),
+                                                locals.i.changeby(1)
+                                ]
+                ] for lst, snapshot_dram in zip(banks, snapshot_banks)]
+]
+
+# Loads the machine state from a list in the snapshot layout and its DRAM lists
+def load_state (locals, state, state_banks): return [
+                jit_clear(),
+                uart.delete_all(),
+                input.delete_all(),
+                input_head <= 0,
+                waiting <= 0,
+                pc <= state[0],
+                ticks <= state[1],
+                top <= state[2],
+                x <= state[3],
+                y <= state[4],
+                mtimecmp_lo <= state[5],
+                mtimecmp_hi <= state[6],
+                tile_map <= state[7],
+                locals.pos <= 8,
+                [[
+                                lst.delete_all(),
+                                Repeat (size) [
+                                                lst.append(state[locals.pos]),
+                                                locals.pos.changeby(1)
+                                ]
+                ] for lst, size in state_lists],
+                [[
+                                lst.delete_all(),
+                                locals.i <= 0,
+                                Repeat (state_dram.len()) [
+                                                lst.append(state_dram[locals.i]),
+                                                locals.i.changeby(1)
+                                ]
+                ] for lst, state_dram in zip(banks, state_banks)],
+                redraw().inline(),
+                dirty <= 1
+]
+
+@emu.proc_def()
+def restore_snapshot (locals): return [
+                If (snapshot.len() < SNAPSHOT_SIZE) [
+                                StopThisScript()
+                ],
+                load_state(locals, snapshot, snapshot_banks)
+]
+
+# Starts a pre-booted project. The lists already hold the boot state when
+# the project is first loaded; later starts restore it from _BOOT.
+if boot:
+                @emu.proc_def()
+                def resume (locals): return [
+                                If (dirty == 1) [
+                                                load_state(locals, boot_state, boot_banks)
+                                ].Else [
+                                                dirty <= 1,
+                                                input.delete_all(),
+                                                input_head <= 0,
+                                                redraw().inline()
                                 ]
                 ]
+
+emu.on_press(SAVE_KEY, [
+                save_snapshot()
+])
+
+emu.on_press(RESTORE_KEY, [
+                restore_snapshot()
+])
+
+# Guest instructions to run per frame before yielding to draw and read input.
+# A system instruction also ends the frame early, and after wfi frames skip
+# the guest until it has something to do.
+FRAME_BUDGET = 20000
+
+@emu.proc_def()
+def loop (locals): return [
+                If (waiting == 1) [
+                                read_mtime().inline(),
+                                If ((input.len() > input_head).OR(mtime > mtimecmp_hi * 4294967296 + mtimecmp_lo - 1)) [
+                                                waiting <= 0
+                                ]
+                ],
+                If (waiting == 0) [
+                                execute.running <= 1,
+                                locals.budget <= ticks + FRAME_BUDGET,
+                                RepeatUntil ((execute.running == 0).OR(ticks > locals.budget)) [
+                                                tick().inline()
+                                ]
+                ],
+                draw()
 ]
 
 emu.on_flag([
-            reset(),
+            resume() if boot else reset(),
             Forever [
             loop()
             ]
@@ -1214,30 +2671,55 @@ emu.on_flag([
 symbols = '!"#$%&\'()*+,-./0123456789:;<=>?@[\\]^_`{}'
 lowercase = 'abcdefghijklmnopqrstuvwxyz'
 
-for c in symbols:
-                emu.on_press(c, [
-                                input.append(ord(c))
-                ])
+# Queues a typed key, shifted if shift is held
+@emu.proc_def()
+def type_key (locals, code, shifted): return [
+                If (KeyPressed("shift")) [
+                                input.append(shifted)
+                ].Else [
+                                input.append(code)
+                ]
+]
 
-for c in lowercase:
-                emu.on_press(c, [
-                                If (KeyPressed("shift")) [
-                                                input.append(ord(c.upper()))
-                                ].Else [
-                                                input.append(ord(c))
-                                ]
+# One hat per key, so each press is queued once even when keys overlap
+typed_keys = {c: c for c in symbols + lowercase}
+typed_keys.update({"enter": "\n", "space": " ", "backspace": "\b"})
+
+for key, c in typed_keys.items():
+                emu.on_press(key, [
+                                type_key(ord(c), ord(c.upper()))
                 ])
 
-emu.on_press("enter", [
-                input.append(ord("\n"))
-])
+# Key that asks for a line of text and queues it as input, for pasting
+PASTE_KEY = "down arrow"
 
-emu.on_press("space", [
-                input.append(ord(" "))
-])
+# Costume number of "cursor"; the capital letter costumes come after it.
+# Switching costume by name is case-sensitive, unlike every string compare.
+CURSOR_COSTUME = 256 + 2
+
+@emu.proc_def()
+def paste_line (locals, text): return [
+                locals.i[:text.len():1] >> [
+                                locals.char <= text[locals.i],
+                                locals.code <= ascii_lut.index(locals.char),
+                                If ((locals.code > 64).AND(locals.code < 91)) [
+                                                SetCostume("cursor"),
+                                                SetCostume(locals.char),
+                                                If (CostumeNumber() == CURSOR_COSTUME) [ # lowercase
+                                                                locals.code.changeby(32)
+                                                ]
+                                ],
+                                If (locals.code > -1) [
+                                                input.append(locals.code)
+                                ]
+                ],
+                input.append(ord("\n")),
+                SetCostume("cursor")
+]
 
-emu.on_press("backspace", [
-                input.append(ord("\b"))
+emu.on_press(PASTE_KEY, [
+                AskAndWait(),
+                paste_line(Answer())
 ])
 
 from PIL import Image, ImageFont, ImageDraw
@@ -1258,4 +2740,28 @@ for a in range(256):
 
 emu.add_costume("cursor", BytesIO(b'<svg width="16" height="1"><rect width="100%" height="100%" fill="white" stroke="transparent"/></svg>').getvalue(), "svg", (0, -32 + 1))
 
+for c in "ABCDEFGHIJKLMNOPQRSTUVWXYZ":
+                emu.add_costume(c, BytesIO(b'<svg width="1" height="1"></svg>').getvalue(), "svg")
+
+# Tiles are drawn at the sprite's size of 50, so they are made at twice the
+# size, and bitmaps at twice that again since they show at half resolution,
+# as the font does. Those not in --tiles are plain RGB332 colours.
+tiles = []
+if args.tiles:
+                sheet = Image.open(args.tiles).convert("RGBA")
+                for row in range(sheet.height // 16):
+                                for col in range(sheet.width // 16):
+                                                tile = sheet.crop((col * 16, row * 16, col * 16 + 16, row * 16 + 16))
+                                                buffer = BytesIO()
+                                                tile.resize((64, 64), Image.NEAREST).save(buffer, format="png")
+                                                tiles.append((buffer.getvalue(), "png"))
+
+for a in range(256):
+                if a < len(tiles):
+                                emu.add_costume("tile" + str(a), *tiles[a])
+                else:
+                                colour = "#%02x%02x%02x" % ((a >> 5) * 255 // 7, (a >> 2 & 7) * 255 // 7, (a & 3) * 255 // 3)
+                                emu.add_costume("tile" + str(a), BytesIO(('<svg width="32" height="32"><rect width="100%" height="100%" fill="'
+                                                + colour + '" stroke="transparent"/></svg>').encode()).getvalue(), "svg")
+
 project.save("out/risc-v.sb3")
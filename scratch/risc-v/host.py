@@ -0,0 +1,679 @@
+# Host-side reference model of the Scratch RV32IM emulator. It has the same
+# DRAM layout, MMIO devices and console, and runs guests thousands of times
+# faster than a Scratch VM. The build uses it to pre-boot guests.
+#
+#   python3 host.py guest.elf [--steps N] [--until ADDR] [--input TEXT]
+#                             [--word-dram | --banks N | --dram-size BYTES]
+
+import argparse
+import struct
+import sys
+import time
+
+DRAM_BASE = 0x80000000
+
+# MMIO device pages
+MTIMECMP = 0x02004000
+MTIME = 0x0200b000
+UART = 0x10000000
+PEN = 0x10002000
+TRIANGLE = 0x10003000
+DMA = 0x10004000
+TILES = 0x10005000
+
+TILE_COLS = 30
+TILE_ROWS = 22
+
+# Bytes in each DRAM list of a build with DRAM_BANKS
+BANK_SIZE = 0x20000
+
+# DRAM_SIZE of a build with the given WORD_DRAM and DRAM_BANKS settings
+def dram_size (word_dram=False, banks=1):
+                return 800000 if word_dram else BANK_SIZE * banks if banks > 1 else 200000
+
+# Timer ticks per second of mtime, which counts from the start of 2000
+MTIME_FREQ = 1000000
+EPOCH_2000 = 946684800
+
+# cycle, time and instret, then their upper halves
+COUNTER_CSRS = (0xc00, 0xc01, 0xc02, 0xc80, 0xc81, 0xc82)
+
+def signed (value):
+                return value - 0x100000000 if value & 0x80000000 else value
+
+# Returns the bytes from DRAM_BASE to the end of the last loadable segment
+# (with BSS zeroed) and the entry point of an RV32 ELF file
+def load_elf (path, dram_size):
+                data = open(path, "rb").read()
+                if data[:4] != b"\x7fELF" or data[4] != 1 or data[5] != 1:
+                                raise Exception(path + " is not a 32-bit little-endian ELF file")
+                (e_type, e_machine, e_version, e_entry, e_phoff, e_shoff, e_flags,
+                 e_ehsize, e_phentsize, e_phnum) = struct.unpack_from("<HHIIIIIHHH", data, 16)
+                if e_machine != 243:
+                                raise Exception(path + " is not a RISC-V ELF file")
+                image = bytearray()
+                for i in range(e_phnum):
+                                (p_type, p_offset, p_vaddr, p_paddr, p_filesz, p_memsz,
+                                 p_flags, p_align) = struct.unpack_from("<8I", data, e_phoff + i * e_phentsize)
+                                if p_type != 1 or p_memsz == 0: # PT_LOAD
+                                                continue
+                                start = p_paddr - DRAM_BASE
+                                if start < 0 or start + p_memsz > dram_size:
+                                                raise Exception("Segment at " + hex(p_paddr) + " does not fit in DRAM")
+                                end = start + p_memsz
+                                if len(image) < end:
+                                                image.extend(bytes(end - len(image)))
+                                image[start:end] = data[p_offset:p_offset + p_filesz] + bytes(p_memsz - p_filesz)
+                return image, e_entry
+
+# Raised before an instruction the machine will not run: a device access or
+# counter read when running strict, a compressed instruction without rvc, a
+# jump outside DRAM, or a wait or exit.
+class Stop (Exception):
+                pass
+
+class Machine:
+                # With strict set, the guest stops before touching any device other
+                # than UART output, whose effect on the project is fully known.
+                # Without rvc, compressed instructions stop the guest, as they do in
+                # a project built without RVC.
+                def __init__ (self, image, entry, dram_size, rows, cols, strict=False, rvc=True):
+                                self.dram = bytearray(dram_size)
+                                self.dram[:len(image)] = image
+                                self.words = memoryview(self.dram).cast("I")
+                                # Decoded instructions by (pc - DRAM_BASE) / 2, None until decoded
+                                self.cache = [None] * (dram_size // 2)
+                                self.regs = [0] * 32
+                                self.regs[2] = DRAM_BASE + dram_size
+                                self.csrs = [0] * 4096
+                                self.pc = entry
+                                self.ticks = 0
+                                self.strict = strict
+                                self.rvc = rvc
+                                self.input = bytearray()
+                                self.mtimecmp = 0xffffffffffffffff
+                                self.exit_code = None
+                                # Pen and triangle operations, in order
+                                self.gfx = []
+                                self.pen_x = 0
+                                self.triangle = [0] * 5
+                                self.dma = [0] * 3 # source, destination, length
+                                self.tile_map = 0
+                                # Tile indices as last presented
+                                self.tiles = None
+                                self.rows = rows
+                                self.cols = cols
+                                self.console = [0] * (rows * cols)
+                                self.top = 0
+                                self.x = 0
+                                self.y = 0
+                                # Handlers by funct3
+                                self.op_imm = [self.op_addi, self.op_slli, self.op_slti, self.op_sltiu, self.op_xori, None, self.op_ori, self.op_andi]
+                                self.op_reg = [self.op_add, self.op_sll, self.op_slt, self.op_sltu, self.op_xor, self.op_srl, self.op_or, self.op_and]
+                                self.op_branch = {0: self.op_beq, 1: self.op_bne, 4: self.op_blt, 5: self.op_bge, 6: self.op_bltu, 7: self.op_bgeu}
+
+                # Console, following new_line and draw_char
+
+                def clear_row (self):
+                                row = ((self.top + self.y) % self.rows) * self.cols
+                                self.console[row:row + self.cols] = [0] * self.cols
+
+                def new_line (self):
+                                self.x = 0
+                                self.y += 1
+                                if self.y == self.rows:
+                                                self.y = self.rows - 1
+                                                self.top = (self.top + 1) % self.rows
+                                self.clear_row()
+
+                def write (self, code):
+                                if code == 10:
+                                                self.new_line()
+                                                return
+                                if code == 8:
+                                                if self.x > 0:
+                                                                self.x -= 1
+                                                self.console[((self.top + self.y) % self.rows) * self.cols + self.x] = 0
+                                                return
+                                if self.x == self.cols:
+                                                self.new_line()
+                                self.console[((self.top + self.y) % self.rows) * self.cols + self.x] = code
+                                self.x += 1
+
+                def screen (self):
+                                lines = []
+                                for row in range(self.rows):
+                                                base = ((self.top + row) % self.rows) * self.cols
+                                                lines.append("".join(chr(c) if c else " " for c in self.console[base:base + self.cols]).rstrip())
+                                return "\n".join(lines).rstrip("\n")
+
+                # Devices, following the CLINT timer, uart_load, uart_store, pen_store,
+                # triangle_store, dma_store and tile_store
+
+                def mtime (self):
+                                return int((time.time() - EPOCH_2000) * MTIME_FREQ)
+
+                def hw_load (self, addr, size):
+                                if self.strict:
+                                                raise Stop("device access at " + hex(addr))
+                                page = addr & ~0xfff
+                                offset = addr - page
+                                if page == MTIMECMP and offset in (0, 4):
+                                                return (self.mtimecmp >> offset * 8) & 0xffffffff
+                                if page == MTIME and offset in (0xff8, 0xffc):
+                                                return (self.mtime() >> (offset - 0xff8) * 8) & 0xffffffff
+                                if page == DMA and offset in (0, 4, 8):
+                                                return self.dma[offset // 4]
+                                if page == TILES and offset == 0:
+                                                return self.tile_map
+                                if page != UART:
+                                                return 0 # unmapped registers read as 0
+                                value = 0
+                                if offset == 0 and self.input:
+                                                value = self.input.pop(0)
+                                if offset < 6 and offset + size > 5 and self.input:
+                                                value += 1 << (5 - offset) * 8 # line status: data ready
+                                return value
+
+                def hw_store (self, addr, value, size):
+                                page = addr & ~0xfff
+                                offset = addr - page
+                                if page == UART:
+                                                if offset == 0:
+                                                                self.write(value & 0xff)
+                                                return
+                                if self.strict:
+                                                raise Stop("device access at " + hex(addr))
+                                if page == MTIMECMP and offset in (0, 4):
+                                                shift = offset * 8
+                                                self.mtimecmp = (self.mtimecmp & ~(0xffffffff << shift)) | (value & 0xffffffff) << shift
+                                                return
+                                if page == TILES:
+                                                if offset == 0:
+                                                                self.tile_map = value
+                                                elif offset == 4 and self.tile_map:
+                                                                start = self.tile_map - DRAM_BASE
+                                                                if 0 <= start and start + TILE_COLS * TILE_ROWS <= len(self.dram):
+                                                                                self.tiles = bytes(self.dram[start:start + TILE_COLS * TILE_ROWS])
+                                                return
+                                if page == DMA:
+                                                if offset in (0, 4, 8):
+                                                                self.dma[offset // 4] = value
+                                                elif offset == 12:
+                                                                self.dma_run(value)
+                                                return
+                                for i in range(size):
+                                                byte = (value >> i * 8) & 0xff
+                                                if page == PEN:
+                                                                self.pen_store(offset + i, byte)
+                                                elif page == TRIANGLE:
+                                                                self.triangle_store(offset + i, byte)
+
+                def pen_store (self, offset, byte):
+                                if offset == 0:
+                                                self.pen_x = byte
+                                elif offset == 1:
+                                                self.gfx.append(("goto", self.pen_x, byte))
+                                elif offset == 2:
+                                                self.gfx.append(("color", byte))
+                                elif offset == 3:
+                                                self.gfx.append(("down", byte) if byte else ("up",))
+                                elif offset == 4: # clear_screen
+                                                self.gfx.append(("clear",))
+                                                self.console = [0] * (self.rows * self.cols)
+                                                self.top = 0
+                                                self.x = 0
+                                                self.y = 0
+
+                def triangle_store (self, offset, byte):
+                                if offset < 5:
+                                                self.triangle[offset] = byte
+                                elif offset == 5:
+                                                self.gfx.append(("triangle", *self.triangle, byte))
+
+                def dma_run (self, mode):
+                                src, dst, length = self.dma[0] - DRAM_BASE, self.dma[1] - DRAM_BASE, self.dma[2]
+                                size = len(self.dram)
+                                if length < 1 or dst < 0 or dst + length > size:
+                                                return
+                                if mode == 1 and 0 <= src and src + length <= size:
+                                                self.dram[dst:dst + length] = self.dram[src:src + length]
+                                elif mode == 2:
+                                                self.dram[dst:dst + length] = bytes([src & 0xff]) * length
+                                for i in range(max((dst >> 1) - 3, 0), ((dst + length - 1) >> 1) + 1):
+                                                self.cache[i] = None
+
+                # Bus
+
+                def load (self, addr, size):
+                                index = addr - DRAM_BASE
+                                if addr < DRAM_BASE:
+                                                return self.hw_load(addr, size)
+                                if size == 4 and not index & 3 and index < len(self.dram):
+                                                return self.words[index >> 2]
+                                # Bytes past the end of DRAM read as 0, like missing list items
+                                return int.from_bytes(self.dram[index:index + size].ljust(size, b"\0"), "little")
+
+                def store (self, addr, value, size):
+                                index = addr - DRAM_BASE
+                                if addr < DRAM_BASE:
+                                                self.hw_store(addr, value, size)
+                                                return
+                                if size == 4 and not index & 3 and index < len(self.dram):
+                                                self.words[index >> 2] = value
+                                                end = index + 4
+                                else:
+                                                # Bytes past the end of DRAM are dropped
+                                                end = min(index + size, len(self.dram))
+                                                if index >= end:
+                                                                return
+                                                self.dram[index:end] = (value & ((1 << size * 8) - 1)).to_bytes(size, "little")[:end - index]
+                                # Instructions starting in the written bytes, or 2 bytes before them
+                                for i in range(max((index >> 1) - 1, 0), ((end - 1) >> 1) + 1):
+                                                self.cache[i] = None
+
+                # Decoding
+
+                def decode (self, inst):
+                                opcode = inst & 0x7f
+                                rd = (inst >> 7) & 0x1f
+                                funct3 = (inst >> 12) & 7
+                                rs1 = (inst >> 15) & 0x1f
+                                rs2 = (inst >> 20) & 0x1f
+                                imm = signed(inst) >> 20
+                                if opcode == 0b0010011:
+                                                if funct3 == 5:
+                                                                return (self.op_srai if inst >> 30 & 1 else self.op_srli, 4, rd, rs1, imm & 0x1f)
+                                                return (self.op_imm[funct3], 4, rd, rs1, imm & 0x1f if funct3 == 1 else imm)
+                                if opcode == 0b0110011:
+                                                if inst >> 25 == 1:
+                                                                return (self.op_mul if funct3 < 4 else self.op_div, 4, rd, rs1, rs2, funct3)
+                                                if inst >> 30 & 1:
+                                                                return (self.op_sra if funct3 == 5 else self.op_sub, 4, rd, rs1, rs2)
+                                                return (self.op_reg[funct3], 4, rd, rs1, rs2)
+                                if opcode == 0b0000011:
+                                                return (self.op_load, 4, rd, rs1, imm, 1 << (funct3 & 3), funct3 < 4)
+                                if opcode == 0b0100011:
+                                                return (self.op_store, 4, rs2, rs1, (imm & ~0x1f) | rd, 1 << funct3)
+                                if opcode == 0b1100011:
+                                                offset = ((signed(inst) >> 19) & ~0xfff) | ((inst & 0x80) << 4) | ((inst >> 20) & 0x7e0) | ((inst >> 7) & 0x1e)
+                                                return (self.op_branch.get(funct3, self.op_nop), 4, rs1, rs2, offset)
+                                if opcode == 0b1101111:
+                                                offset = ((signed(inst) >> 11) & ~0xfffff) | (inst & 0xff000) | ((inst >> 9) & 0x800) | ((inst >> 20) & 0x7fe)
+                                                return (self.op_jal, 4, rd, 0, offset)
+                                if opcode == 0b1100111:
+                                                return (self.op_jalr, 4, rd, rs1, imm)
+                                if opcode == 0b0110111:
+                                                return (self.op_lui, 4, rd, 0, inst & 0xfffff000)
+                                if opcode == 0b0010111:
+                                                return (self.op_auipc, 4, rd, 0, inst & 0xfffff000)
+                                if inst == 0x00000073:
+                                                return (self.op_ecall, 4, 0, 0, 0)
+                                if inst == 0x10500073:
+                                                return (self.op_wfi, 4, 0, 0, 0)
+                                if opcode == 0b1110011 and funct3 & 3:
+                                                return (self.op_csr, 4, rd, rs1, inst >> 20, funct3)
+                                # System instructions only end the frame in the project
+                                return (self.op_nop, 4, 0, 0, 0) # system / fence / unknown
+
+                # Decodes a 16-bit instruction into the entry of the 32-bit instruction
+                # it expands to, with a size of 2
+                def decode_c (self, inst):
+                                def bits (lo, width):
+                                                return (inst >> lo) & ((1 << width) - 1)
+                                quadrant = inst & 3
+                                funct3 = inst >> 13
+                                rd = bits(7, 5)
+                                rs2 = bits(2, 5)
+                                rd_c = bits(2, 3) + 8
+                                rs1_c = bits(7, 3) + 8
+                                imm = bits(2, 5) - (bits(12, 1) << 5)
+                                offset_lw = (bits(6, 1) << 2) | (bits(10, 3) << 3) | (bits(5, 1) << 6)
+                                if quadrant == 0:
+                                                if funct3 == 0 and inst: # c.addi4spn
+                                                                return (self.op_addi, 2, rd_c, 2, (bits(6, 1) << 2) | (bits(5, 1) << 3) | (bits(11, 2) << 4) | (bits(7, 4) << 6))
+                                                if funct3 == 2: # c.lw
+                                                                return (self.op_load, 2, rd_c, rs1_c, offset_lw, 4, False)
+                                                if funct3 == 6: # c.sw
+                                                                return (self.op_store, 2, rd_c, rs1_c, offset_lw, 4)
+                                elif quadrant == 1:
+                                                if funct3 == 0: # c.addi
+                                                                return (self.op_addi, 2, rd, rd, imm)
+                                                if funct3 in (1, 5): # c.jal, c.j
+                                                                offset = ((bits(3, 3) << 1) | (bits(11, 1) << 4) | (bits(2, 1) << 5) | (bits(7, 1) << 6)
+                                                                                | (bits(6, 1) << 7) | (bits(9, 2) << 8) | (bits(8, 1) << 10)) - (bits(12, 1) << 11)
+                                                                return (self.op_jal, 2, 1 if funct3 == 1 else 0, 0, offset)
+                                                if funct3 == 2: # c.li
+                                                                return (self.op_addi, 2, rd, 0, imm)
+                                                if funct3 == 3 and rd == 2: # c.addi16sp
+                                                                return (self.op_addi, 2, 2, 2, ((bits(6, 1) << 4) | (bits(2, 1) << 5) | (bits(5, 1) << 6)
+                                                                                | (bits(3, 2) << 7)) - (bits(12, 1) << 9))
+                                                if funct3 == 3: # c.lui
+                                                                return (self.op_lui, 2, rd, 0, (imm << 12) & 0xffffffff)
+                                                if funct3 == 4:
+                                                                funct2 = bits(10, 2)
+                                                                if funct2 == 0: # c.srli
+                                                                                return (self.op_srli, 2, rs1_c, rs1_c, rs2)
+                                                                if funct2 == 1: # c.srai
+                                                                                return (self.op_srai, 2, rs1_c, rs1_c, rs2)
+                                                                if funct2 == 2: # c.andi
+                                                                                return (self.op_andi, 2, rs1_c, rs1_c, imm)
+                                                                return ([self.op_sub, self.op_xor, self.op_or, self.op_and][bits(5, 2)], 2, rs1_c, rs1_c, rd_c)
+                                                if funct3 > 5: # c.beqz, c.bnez
+                                                                offset = ((bits(3, 2) << 1) | (bits(10, 2) << 3) | (bits(2, 1) << 5) | (bits(5, 2) << 6)) - (bits(12, 1) << 8)
+                                                                return (self.op_beq if funct3 == 6 else self.op_bne, 2, rs1_c, 0, offset)
+                                elif quadrant == 2:
+                                                if funct3 == 0: # c.slli
+                                                                return (self.op_slli, 2, rd, rd, rs2)
+                                                if funct3 == 2: # c.lwsp
+                                                                return (self.op_load, 2, rd, 2, (bits(4, 3) << 2) | (bits(12, 1) << 5) | (bits(2, 2) << 6), 4, False)
+                                                if funct3 == 4:
+                                                                if not bits(12, 1):
+                                                                                if rs2 == 0: # c.jr
+                                                                                                return (self.op_jalr, 2, 0, rd, 0)
+                                                                                return (self.op_add, 2, rd, 0, rs2) # c.mv
+                                                                if rs2: # c.add
+                                                                                return (self.op_add, 2, rd, rd, rs2)
+                                                                if rd: # c.jalr
+                                                                                return (self.op_jalr, 2, 1, rd, 0)
+                                                                return (self.op_nop, 2, 0, 0, 0) # c.ebreak
+                                                if funct3 == 6: # c.swsp
+                                                                return (self.op_store, 2, rs2, 2, (bits(9, 4) << 2) | (bits(7, 2) << 6), 4)
+                                return (self.op_nop, 2, 0, 0, 0)
+
+                # Instructions. Each takes the decoded entry (handler, size in bytes,
+                # fields) and the address of the instruction, and returns the next pc.
+
+                def op_nop (self, e, pc):
+                                return pc + e[1]
+
+                # Input cannot arrive while running, so this sleeps until the timer
+                # is due, and stops if nothing is left to wait for
+                def op_wfi (self, e, pc):
+                                if self.strict:
+                                                raise Stop("wfi at " + hex(pc))
+                                if not self.input:
+                                                if self.mtimecmp >> 63:
+                                                                raise Stop("waiting for input at " + hex(pc))
+                                                time.sleep(max(self.mtimecmp - self.mtime(), 0) / MTIME_FREQ)
+                                return pc + e[1]
+
+                # CSRs, following csr_access. The counters are read-only, and reading
+                # them stops a strict run as their values depend on the host.
+                def op_csr (self, e, pc):
+                                csr = e[4]
+                                value = e[3] if e[5] > 4 else self.regs[e[3]]
+                                if csr in COUNTER_CSRS:
+                                                if self.strict:
+                                                                raise Stop("counter read at " + hex(pc))
+                                                count = self.mtime() if csr & 0x7f == 1 else self.ticks
+                                                old = count >> 32 if csr & 0x80 else count & 0xffffffff
+                                else:
+                                                old = self.csrs[csr]
+                                                mode = e[5] & 3
+                                                self.csrs[csr] = value if mode == 1 else old | value if mode == 2 else old & ~value
+                                self.regs[e[2]] = old
+                                return pc + e[1]
+
+                # System calls, following syscall. A read with no input queued, and
+                # exit, stop before the ecall, as the project runs it again.
+                def op_ecall (self, e, pc):
+                                regs = self.regs
+                                number, fd, buf, count = regs[17], regs[10], regs[11] - DRAM_BASE, regs[12]
+                                if number in (63, 64) and (buf < 0 or buf + count > len(self.dram)):
+                                                regs[10] = 0xfffffff2 # EFAULT
+                                elif number == 64: # write
+                                                if fd in (1, 2):
+                                                                for code in self.dram[buf:buf + count]:
+                                                                                self.write(code)
+                                                                regs[10] = count
+                                                else:
+                                                                regs[10] = 0xfffffff7 # EBADF
+                                elif number == 63: # read
+                                                if fd != 0:
+                                                                regs[10] = 0xfffffff7
+                                                                return pc + e[1]
+                                                if not self.input and count:
+                                                                raise Stop("waiting for input at " + hex(pc))
+                                                line = self.input[:count]
+                                                if 10 in line:
+                                                                line = line[:line.index(10) + 1]
+                                                del self.input[:len(line)]
+                                                for i, code in enumerate(line):
+                                                                self.store(DRAM_BASE + buf + i, code, 1)
+                                                regs[10] = len(line)
+                                elif number in (93, 94): # exit
+                                                self.exit_code = regs[10]
+                                                raise Stop("exit " + str(signed(regs[10])))
+                                return pc + e[1]
+
+                def op_addi (self, e, pc):
+                                self.regs[e[2]] = (self.regs[e[3]] + e[4]) & 0xffffffff
+                                return pc + e[1]
+
+                def op_slli (self, e, pc):
+                                self.regs[e[2]] = (self.regs[e[3]] << e[4]) & 0xffffffff
+                                return pc + e[1]
+
+                def op_slti (self, e, pc):
+                                self.regs[e[2]] = int(signed(self.regs[e[3]]) < e[4])
+                                return pc + e[1]
+
+                def op_sltiu (self, e, pc):
+                                self.regs[e[2]] = int(self.regs[e[3]] < e[4] & 0xffffffff)
+                                return pc + e[1]
+
+                def op_xori (self, e, pc):
+                                self.regs[e[2]] = (self.regs[e[3]] ^ e[4]) & 0xffffffff
+                                return pc + e[1]
+
+                def op_srli (self, e, pc):
+                                self.regs[e[2]] = self.regs[e[3]] >> e[4]
+                                return pc + e[1]
+
+                def op_srai (self, e, pc):
+                                self.regs[e[2]] = (signed(self.regs[e[3]]) >> e[4]) & 0xffffffff
+                                return pc + e[1]
+
+                def op_ori (self, e, pc):
+                                self.regs[e[2]] = (self.regs[e[3]] | e[4]) & 0xffffffff
+                                return pc + e[1]
+
+                def op_andi (self, e, pc):
+                                self.regs[e[2]] = self.regs[e[3]] & e[4] & 0xffffffff
+                                return pc + e[1]
+
+                def op_add (self, e, pc):
+                                regs = self.regs
+                                regs[e[2]] = (regs[e[3]] + regs[e[4]]) & 0xffffffff
+                                return pc + e[1]
+
+                def op_sub (self, e, pc):
+                                regs = self.regs
+                                regs[e[2]] = (regs[e[3]] - regs[e[4]]) & 0xffffffff
+                                return pc + e[1]
+
+                def op_sll (self, e, pc):
+                                regs = self.regs
+                                regs[e[2]] = (regs[e[3]] << (regs[e[4]] & 0x1f)) & 0xffffffff
+                                return pc + e[1]
+
+                def op_slt (self, e, pc):
+                                regs = self.regs
+                                regs[e[2]] = int(signed(regs[e[3]]) < signed(regs[e[4]]))
+                                return pc + e[1]
+
+                def op_sltu (self, e, pc):
+                                regs = self.regs
+                                regs[e[2]] = int(regs[e[3]] < regs[e[4]])
+                                return pc + e[1]
+
+                def op_xor (self, e, pc):
+                                regs = self.regs
+                                regs[e[2]] = regs[e[3]] ^ regs[e[4]]
+                                return pc + e[1]
+
+                def op_srl (self, e, pc):
+                                regs = self.regs
+                                regs[e[2]] = regs[e[3]] >> (regs[e[4]] & 0x1f)
+                                return pc + e[1]
+
+                def op_sra (self, e, pc):
+                                regs = self.regs
+                                regs[e[2]] = (signed(regs[e[3]]) >> (regs[e[4]] & 0x1f)) & 0xffffffff
+                                return pc + e[1]
+
+                def op_or (self, e, pc):
+                                regs = self.regs
+                                regs[e[2]] = regs[e[3]] | regs[e[4]]
+                                return pc + e[1]
+
+                def op_and (self, e, pc):
+                                regs = self.regs
+                                regs[e[2]] = regs[e[3]] & regs[e[4]]
+                                return pc + e[1]
+
+                def op_mul (self, e, pc):
+                                regs = self.regs
+                                a = regs[e[3]]
+                                b = regs[e[4]]
+                                regs[e[2]] = {
+                                                0: lambda: a * b, # mul
+                                                1: lambda: (signed(a) * signed(b)) >> 32, # mulh
+                                                2: lambda: (signed(a) * b) >> 32, # mulhsu
+                                                3: lambda: (a * b) >> 32 # mulhu
+                                }[e[5]]() & 0xffffffff
+                                return pc + e[1]
+
+                def op_div (self, e, pc):
+                                regs = self.regs
+                                a = regs[e[3]]
+                                b = regs[e[4]]
+                                funct3 = e[5]
+                                if funct3 == 4: # div
+                                                sa = signed(a)
+                                                sb = signed(b)
+                                                if b == 0:
+                                                                value = -1
+                                                else:
+                                                                value = abs(sa) // abs(sb)
+                                                                if (sa < 0) != (sb < 0):
+                                                                                value = -value
+                                elif funct3 == 5: # divu
+                                                value = a // b if b else -1
+                                elif funct3 == 6: # rem
+                                                sa = signed(a)
+                                                if b == 0:
+                                                                value = sa
+                                                else:
+                                                                value = abs(sa) % abs(signed(b))
+                                                                if sa < 0:
+                                                                                value = -value
+                                else: # remu
+                                                value = a % b if b else a
+                                regs[e[2]] = value & 0xffffffff
+                                return pc + e[1]
+
+                def op_load (self, e, pc):
+                                size = e[5]
+                                value = self.load((self.regs[e[3]] + e[4]) & 0xffffffff, size)
+                                if e[6] and value >> (size * 8 - 1):
+                                                value += 0x100000000 - (1 << size * 8)
+                                self.regs[e[2]] = value
+                                return pc + e[1]
+
+                def op_store (self, e, pc):
+                                self.store((self.regs[e[3]] + e[4]) & 0xffffffff, self.regs[e[2]], e[5])
+                                return pc + e[1]
+
+                def op_beq (self, e, pc):
+                                return pc + e[4] if self.regs[e[2]] == self.regs[e[3]] else pc + e[1]
+
+                def op_bne (self, e, pc):
+                                return pc + e[4] if self.regs[e[2]] != self.regs[e[3]] else pc + e[1]
+
+                def op_blt (self, e, pc):
+                                return pc + e[4] if signed(self.regs[e[2]]) < signed(self.regs[e[3]]) else pc + e[1]
+
+                def op_bge (self, e, pc):
+                                return pc + e[4] if signed(self.regs[e[2]]) >= signed(self.regs[e[3]]) else pc + e[1]
+
+                def op_bltu (self, e, pc):
+                                return pc + e[4] if self.regs[e[2]] < self.regs[e[3]] else pc + e[1]
+
+                def op_bgeu (self, e, pc):
+                                return pc + e[4] if self.regs[e[2]] >= self.regs[e[3]] else pc + e[1]
+
+                def op_jal (self, e, pc):
+                                self.regs[e[2]] = pc + e[1]
+                                return pc + e[4]
+
+                def op_jalr (self, e, pc):
+                                target = (self.regs[e[3]] + e[4]) & 0xfffffffe
+                                self.regs[e[2]] = pc + e[1]
+                                return target
+
+                def op_lui (self, e, pc):
+                                self.regs[e[2]] = e[4]
+                                return pc + e[1]
+
+                def op_auipc (self, e, pc):
+                                self.regs[e[2]] = (pc + e[4]) & 0xffffffff
+                                return pc + e[1]
+
+                # Runs until steps instructions have executed or pc reaches until.
+                # Returns the reason it stopped.
+                def run (self, steps, until=None):
+                                cache = self.cache
+                                regs = self.regs
+                                pc = self.pc
+                                ticks = self.ticks
+                                limit = len(self.dram) - 2
+                                align = 1 if self.rvc else 3
+                                try:
+                                                while ticks < steps:
+                                                                if pc == until:
+                                                                                return "reached " + hex(until)
+                                                                index = pc - DRAM_BASE
+                                                                if index < 0 or index > limit or index & align:
+                                                                                raise Stop("pc out of range at " + hex(pc))
+                                                                entry = cache[index >> 1]
+                                                                if entry is None:
+                                                                                inst = self.load(pc, 4)
+                                                                                if inst & 3 != 3 and not self.rvc:
+                                                                                                raise Stop("compressed instruction at " + hex(pc))
+                                                                                entry = cache[index >> 1] = self.decode(inst) if inst & 3 == 3 else self.decode_c(inst & 0xffff)
+                                                                self.ticks = ticks # for the counter CSRs
+                                                                pc = entry[0](entry, pc)
+                                                                regs[0] = 0
+                                                                ticks += 1
+                                except Stop as e:
+                                                return str(e)
+                                finally:
+                                                self.pc = pc
+                                                self.ticks = ticks
+                                return "ran " + str(steps) + " instructions"
+
+if __name__ == "__main__":
+                parser = argparse.ArgumentParser(description="Run an RV32 ELF on the reference model.")
+                parser.add_argument("elf")
+                parser.add_argument("--steps", type=int, default=100000000, help="instructions to run at most")
+                parser.add_argument("--until", type=lambda s: int(s, 0), metavar="ADDR", help="stop when the guest reaches ADDR")
+                parser.add_argument("--input", default="", help="text queued on the UART")
+                parser.add_argument("--word-dram", action="store_true", help="size DRAM as a WORD_DRAM build")
+                parser.add_argument("--banks", type=int, default=1, metavar="N", help="size DRAM as a build with DRAM_BANKS = N")
+                parser.add_argument("--dram-size", type=int, metavar="BYTES", help="size DRAM explicitly")
+                args = parser.parse_args()
+                size = args.dram_size or dram_size(args.word_dram, args.banks)
+                image, entry = load_elf(args.elf, size)
+                machine = Machine(image, entry, size, 21, 60)
+                machine.input.extend(args.input.encode())
+                start = time.perf_counter()
+                reason = machine.run(args.steps, args.until)
+                elapsed = time.perf_counter() - start
+                print(machine.screen())
+                print("Stopped: %s, pc %#x" % (reason, machine.pc), file=sys.stderr)
+                print("%d instructions in %.2f s, %.0f instructions per second"
+                                % (machine.ticks, elapsed, machine.ticks / max(elapsed, 1e-9)), file=sys.stderr)
+                if machine.exit_code is not None:
+                                sys.exit(machine.exit_code & 0xff)